@@ -4,19 +4,26 @@ from __future__ import annotations
 import base64
 import os
 import shutil
+import sqlite3
+import threading
+import time
 from io import BytesIO
 from pathlib import Path
-from typing import Literal
+from typing import TYPE_CHECKING, Literal
 
+import imageio_ffmpeg
+import numpy as np
 import tantivy
 import torch
-from moviepy.editor import VideoFileClip
 from PIL import Image
 from pydantic import BaseModel, Field
 from transformers import BlipForConditionalGeneration, BlipProcessor
 
 import bentoml
 
+if TYPE_CHECKING:
+    from collections.abc import Iterable, Iterator
+
 # ---------------------------
 # Helper Models and Functions
 # ---------------------------
@@ -65,6 +72,126 @@ class Docs(BaseModel):
     timestamps: list[int] = Field(default=[], description="Document timestamps")
 
 
+def materialize_hits(searcher: tantivy.Searcher, hits: list[tuple[float, tantivy.DocAddress]]) -> list[dict]:
+    """Turn search hits into results in rank order, fetching each stored document once."""
+    results = []
+    seen = set()
+    for score, address in hits:
+        doc = searcher.doc(address)
+        key = (doc["filename"][0], doc["timestamp"][0])
+        if key in seen:
+            continue
+        seen.add(key)
+        results.append(
+            {
+                "filename": key[0],
+                "caption": doc["caption"][0],
+                "type": doc["type"][0],
+                "timestamp": key[1],
+                "score": score,
+            },
+        )
+    return results
+
+
+def frame_signature(frame: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Small grayscale thumbnail and normalized 32-bin histogram of an HWC frame."""
+    gray = frame.mean(axis=2)
+    rows = np.linspace(0, gray.shape[0] - 1, 16).astype(int)
+    cols = np.linspace(0, gray.shape[1] - 1, 16).astype(int)
+    histogram = np.bincount((gray.ravel() * 32 / 256).astype(int), minlength=32)
+    return gray[np.ix_(rows, cols)] / 255, histogram / histogram.sum()
+
+
+def stream_frames(path: Path, fps: float, size: int) -> Iterator[tuple[float, np.ndarray]]:
+    """Decode a video once, yielding `fps` frames per second already scaled to `size` x `size` by ffmpeg."""
+    reader = imageio_ffmpeg.read_frames(
+        path.as_posix(),
+        pix_fmt="rgb24",
+        output_params=["-vf", f"fps={fps},scale={size}:{size}:flags=bicubic"],
+    )
+    try:
+        width, height = next(reader)["size"]
+        for index, buffer in enumerate(reader):
+            yield index / fps, np.frombuffer(buffer, dtype=np.uint8).reshape(height, width, 3)
+    finally:
+        reader.close()
+
+
+def select_frames(frames: Iterable[tuple[float, np.ndarray]]) -> Iterator[tuple[float, np.ndarray]]:
+    """Keep frames that differ enough from the last kept one, within MIN_INTERVAL and MAX_INTERVAL."""
+    last_time = None
+    last_signature = None
+    for t, frame in frames:
+        signature = frame_signature(frame)
+        if last_time is not None:
+            elapsed = t - last_time
+            if elapsed < MIN_INTERVAL:
+                continue
+            novelty = (
+                float(np.abs(signature[0] - last_signature[0]).mean())
+                + float(np.abs(signature[1] - last_signature[1]).sum()) / 2
+            ) / 2
+            if elapsed < MAX_INTERVAL and novelty < NOVELTY_THRESHOLD:
+                continue
+        last_time = t
+        last_signature = signature
+        yield t, frame
+
+
+def perceptual_hash(image: Image.Image) -> str:
+    """256-bit difference hash, computed like the searcher's so both share the caption cache."""
+    frame = image.convert("RGB").resize((INPUT_SIZE, INPUT_SIZE), Image.Resampling.BICUBIC)
+    pixels = np.asarray(frame.convert("L").resize((17, 16), Image.Resampling.BOX), dtype=np.int16)
+    return np.packbits(pixels[:, 1:] > pixels[:, :-1]).tobytes().hex()
+
+
+class CaptionCache:
+    """The searcher's SQLite caption cache, keyed by `model_key:perceptual hash`, with least-recently-used eviction.
+
+    Kept in step with `searcher/caption_cache.py`: the bento is built from this directory alone, so it
+    cannot import the searcher's modules.
+    """
+
+    def __init__(self, path: Path, model_key: str, max_entries: int = 1_000_000) -> None:
+        """Open (or create) the cache database."""
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.model_key = model_key
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path.as_posix(), check_same_thread=False, timeout=5)
+        with self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS captions ("
+                "key TEXT PRIMARY KEY, caption TEXT NOT NULL, last_used REAL NOT NULL)",
+            )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS captions_last_used ON captions (last_used)")
+
+    def get(self, image_hash: str) -> str | None:
+        """Return the cached caption of an image hash."""
+        key = f"{self.model_key}:{image_hash}"
+        with self.lock, self.connection:
+            row = self.connection.execute("SELECT caption FROM captions WHERE key = ?", (key,)).fetchone()
+            if row:
+                self.connection.execute("UPDATE captions SET last_used = ? WHERE key = ?", (time.time(), key))
+        return row[0] if row else None
+
+    def put(self, image_hash: str, caption: str) -> None:
+        """Store the caption of an image hash and evict the least recently used entries beyond `max_entries`."""
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO captions (key, caption, last_used) VALUES (?, ?, ?)",
+                (f"{self.model_key}:{image_hash}", caption, time.time()),
+            )
+            excess = self.connection.execute("SELECT COUNT(*) FROM captions").fetchone()[0] - self.max_entries
+            if excess > 0:
+                self.connection.execute(
+                    "DELETE FROM captions WHERE key IN (SELECT key FROM captions ORDER BY last_used LIMIT ?)",
+                    (excess,),
+                )
+
+
 # ---------------------------
 # Constants and Paths
 # ---------------------------
@@ -72,9 +199,14 @@ class Docs(BaseModel):
 VIDEOS_PATH = Path("..", "..", "data", "videos")
 IMAGES_PATH = Path("..", "..", "data", "images")
 INDEX_PATH = Path("..","index", "data")
+CAPTION_CACHE_PATH = Path("..", "..", "index", "caption_cache.sqlite3")
 
-INTERVAL = 5
+PROBE_FPS = 2
+NOVELTY_THRESHOLD = 0.15
+MIN_INTERVAL = 1
+MAX_INTERVAL = 30
 BATCH_SIZE = 16
+INPUT_SIZE = 384
 
 
 # ---------------------------
@@ -112,6 +244,8 @@ class BlipTantivyService:
             self.device = "cpu"
             self.model = BlipForConditionalGeneration.from_pretrained(self.model_path)
 
+        self.caption_cache = CaptionCache(CAPTION_CACHE_PATH, model_key=f"{self.model_path}#eager@{INPUT_SIZE}")
+
         VIDEOS_PATH.mkdir(parents=True, exist_ok=True)
         IMAGES_PATH.mkdir(parents=True, exist_ok=True)
 
@@ -176,14 +310,12 @@ class BlipTantivyService:
         print(f"Starting video processing: {filename}")
         path = VIDEOS_PATH / filename
         try:
-            video = VideoFileClip(path.as_posix())
             images = []
             timestamps = []
 
-            for t in range(0, int(video.duration), INTERVAL):
-                frame = video.get_frame(t)
+            for t, frame in select_frames(stream_frames(path, PROBE_FPS, INPUT_SIZE)):
                 images.append(Image.fromarray(frame))
-                timestamps.append(t)
+                timestamps.append(int(t))
 
                 if len(images) >= BATCH_SIZE:
                     captions = self._generate_captions_from_images(images)
@@ -207,7 +339,6 @@ class BlipTantivyService:
                 )
                 self.add_multiple(docs)
 
-            video.close()
             print(f"Successfully processed video: {filename}")
         except (Exception, BaseException) as e:
             print(f"Error processing video {filename}: {e}")
@@ -218,8 +349,11 @@ class BlipTantivyService:
         path = IMAGES_PATH / filename
         try:
             image = Image.open(path)
-            captions = self._generate_captions_from_images([image])
+            image_hash = perceptual_hash(image)
+            caption = self.caption_cache.get(image_hash)
+            captions = [caption] if caption else self._generate_captions_from_images([image])
             if captions and captions[0]:
+                self.caption_cache.put(image_hash, captions[0])
                 docs = Docs(texts=[captions[0]], filenames=[filename], types=["image"], timestamps=[0])
                 self.add_multiple(docs)
                 print(f"Successfully processed image: {filename}")
@@ -295,30 +429,10 @@ class BlipTantivyService:
                     (tantivy.Occur.Must, type_query),
                 ],
             )
-            results = [
-                {
-                    "filename":searcher.doc(doc)["filename"][0],
-                    "caption": searcher.doc(doc)["caption"][0],
-                    "type": searcher.doc(doc)["type"][0],
-                    "timestamp": searcher.doc(doc)["timestamp"][0],
-                }
-                for _, doc in searcher.search(parsed_query, limit=n).hits
-            ]
-            unique = {
-                (result["filename"], result["caption"], result["type"], result["timestamp"]) for result in results
-            }
-            results = [
-                {
-                    "filename":result[0],
-                    "caption":result[1],
-                    "type":result[2],
-                    "timestamp":result[3],
-                }
-                for result in unique
-            ]
+            results = materialize_hits(searcher, searcher.search(parsed_query, limit=n).hits)
             response = {"response": "okay", "results": results}
         except (Exception, BaseException) as e:
-            return {"response": str(e), "results": {}}
+            return {"response": str(e), "results": []}
         else:
             return response
 
@@ -1,15 +1,24 @@
 """VLM API."""
 
+import asyncio
 import sys
+import time
+from collections.abc import AsyncIterator, Iterator
+from contextlib import asynccontextmanager, contextmanager
 from pathlib import Path
 
 import fastapi
-import torch
 import uvicorn
 import yaml
+from backends import CaptionBackend, load_backend
+from batching import MicroBatcher
+from embeddings import Embedder, encode_embeddings
+from fastapi.responses import JSONResponse
 from loguru import logger
-from request_models import Images, decode_images
-from transformers import BlipForConditionalGeneration, BlipProcessor
+from PIL import Image
+from preprocessing import Preprocessor
+from request_models import Images, Texts, decode_images, decode_raw_images, parse_shapes
+from workers import InferencePool
 
 parent_dir = Path(__file__).resolve().parent.parent
 sys.path.append(str(parent_dir))
@@ -17,8 +26,6 @@ sys.path.append(str(parent_dir))
 from unified_logging.config_types import LoggingConfigs  # noqa: E402
 from unified_logging.logging_client import setup_network_logger_client  # noqa: E402
 
-app = fastapi.FastAPI()
-
 with Path.open(Path("..", "API_KEY.yaml")) as file:
     config = yaml.safe_load(file)
     HF_TOKEN = config["HF_TOKEN"]
@@ -33,67 +40,279 @@ if LOGGING_CONFIG_PATH.exists():
     logger.info("VLM service started with unified logging")
 
 
-class Blip:
-    """Class for BLIP Model."""
+INFERENCE = CONFIG["inference"]
+
+
+class GlobalVariables:
+    """Models of the service, loaded in the background once the server accepts connections."""
+
+    captioning_model: CaptionBackend | None = None
+    inference_pool: InferencePool | None = None
+    preprocessor: Preprocessor | None = None
+    embedder: Embedder | None = None
+    phase: str = "starting"
+    ready: bool = False
+
+
+@contextmanager
+def startup_phase(name: str) -> Iterator[None]:
+    """Log how long a phase of the startup took, so cold-start regressions show up in the logs."""
+    GlobalVariables.phase = name
+    start = time.perf_counter()
+    yield
+    logger.info(f"Startup phase '{name}' took {time.perf_counter() - start:.2f}s")
+
+
+def caption_prepared(prepared: tuple[int, int]) -> list[str]:
+    """Caption a batch prepared in an input buffer, in an inference worker or in this process when there is one."""
+    if GlobalVariables.inference_pool is not None:
+        return GlobalVariables.inference_pool.caption_buffer(prepared)
+    return GlobalVariables.captioning_model.caption_pixels(GlobalVariables.preprocessor.pixels(prepared))
+
+
+async def prepare_batch(images: list[Image.Image]) -> tuple[int, int]:
+    """Prepare a batch in an input buffer of the preprocessor, which is only created once the models load."""
+    return await GlobalVariables.preprocessor.prepare(images)
+
+
+def release_batch(prepared: tuple[int, int]) -> None:
+    """Hand the input buffer of a captioned batch back to the preprocessor."""
+    GlobalVariables.preprocessor.release(prepared)
+
 
-    def __init__(self) -> None:
-        """Load the model into appropriate device."""
-        logger.info("Initializing BLIP model")
-        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-        logger.info(f"Using device: {self.device}")
-        logger.info("Loading BLIP processor")
-        self.processor = BlipProcessor.from_pretrained(
-            "Salesforce/blip-image-captioning-base",
-            token=HF_TOKEN,
+async def caption_batch(images: list[Image.Image]) -> list[str]:
+    """Prepare and caption a batch outside of the batcher."""
+    prepared = await GlobalVariables.preprocessor.prepare(images)
+    try:
+        return await asyncio.to_thread(caption_prepared, prepared)
+    finally:
+        GlobalVariables.preprocessor.release(prepared)
+
+
+batcher = MicroBatcher(
+    infer=caption_prepared,
+    max_batch_size=CONFIG["captioning"]["max_batch_size"],
+    max_wait=CONFIG["captioning"]["max_wait_ms"] / 1000,
+    concurrency=INFERENCE["workers"],
+    prepare=prepare_batch,
+    release=release_batch,
+)
+embedding_batchers = (
+    {
+        kind: MicroBatcher(
+            infer=lambda inputs, kind=kind: getattr(GlobalVariables.embedder, f"embed_{kind}")(inputs),
+            max_batch_size=CONFIG["embeddings"]["max_batch_size"],
+            max_wait=CONFIG["embeddings"]["max_wait_ms"] / 1000,
         )
-        logger.info("Loading BLIP model")
-        try:
-            # if torch._C._cuda_getDeviceCount() > 0:
-            if torch.cuda.is_available() and torch.cuda.device_count() > 0:
-                self.model = BlipForConditionalGeneration.from_pretrained(
-                    "Salesforce/blip-image-captioning-base",
-                    token=HF_TOKEN,
-                ).to(self.device)
-            else:
-                self.device = "cpu"
-                self.model = BlipForConditionalGeneration.from_pretrained(
-                    "Salesforce/blip-image-captioning-base",
-                    token=HF_TOKEN,
-                )
-            logger.info("BLIP model loaded successfully")
-        except BaseExceptionGroup:
-            self.device = "cpu"
-            self.model = BlipForConditionalGeneration.from_pretrained(
-                "Salesforce/blip-image-captioning-base",
+        for kind in ("images", "texts")
+    }
+    if CONFIG["embeddings"]["enabled"]
+    else {}
+)
+
+
+def batch_buckets(max_batch_size: int) -> list[int]:
+    """Batch sizes warmed up before serving: every power of two below `max_batch_size`, and itself."""
+    return [size for size in (2**i for i in range(max_batch_size.bit_length())) if size < max_batch_size] + [
+        max_batch_size,
+    ]
+
+
+async def warmup() -> None:
+    """Caption a dummy batch of every bucket size in every inference worker, and embed one of each input."""
+    size = CONFIG["captioning"]["input_size"]
+    image = Image.new("RGB", (size, size), (127, 127, 127))
+    for bucket in batch_buckets(CONFIG["captioning"]["max_batch_size"]):
+        await asyncio.gather(*(caption_batch([image] * bucket) for _ in range(INFERENCE["workers"])))
+        logger.debug(f"Warmed up batches of {bucket} images")
+    if GlobalVariables.embedder is not None:
+        await asyncio.to_thread(GlobalVariables.embedder.embed_images, [image])
+        await asyncio.to_thread(GlobalVariables.embedder.embed_texts, ["warmup"])
+
+
+def load_embedder() -> Embedder:
+    """Load the CLIP model and check it embeds into the `embeddings.dim` the searcher's vector store is sized for."""
+    embedder = Embedder(CONFIG["embeddings"]["model"], token=HF_TOKEN)
+    if embedder.dim != CONFIG["embeddings"]["dim"]:
+        msg = (
+            f"embeddings.dim is {CONFIG['embeddings']['dim']} but {CONFIG['embeddings']['model']} "
+            f"embeds into {embedder.dim} dimensions"
+        )
+        raise ValueError(msg)
+    return embedder
+
+
+async def load_models() -> None:
+    """Load the models, start the inference workers and warm them up, then report ready."""
+    start = time.perf_counter()
+    try:
+        with startup_phase("load captioning model"):
+            GlobalVariables.captioning_model = await asyncio.to_thread(
+                load_backend,
+                CONFIG["captioning"]["backend"],
+                CONFIG["index"]["model_version"],
                 token=HF_TOKEN,
-            )  # if not enough vram
-            logger.info("BLIP model loaded successfully")
+                onnx_dir=Path(CONFIG["captioning"]["onnx_dir"]),
+            )
+        with startup_phase("allocate input buffers"):
+            # One batch can be prepared while every inference worker runs another.
+            GlobalVariables.preprocessor = Preprocessor(
+                GlobalVariables.captioning_model.processor.image_processor,
+                CONFIG["captioning"]["max_batch_size"],
+                buffers=INFERENCE["workers"] + 1,
+                workers=CONFIG["preprocessing"]["workers"],
+            )
+        if INFERENCE["workers"] > 1:
+            with startup_phase("start inference workers"):
+                pool = InferencePool(
+                    GlobalVariables.captioning_model,
+                    INFERENCE["workers"],
+                    INFERENCE["threads_per_worker"],
+                    buffers=GlobalVariables.preprocessor.buffers,
+                )
+                await asyncio.to_thread(pool.start)
+                GlobalVariables.inference_pool = pool
+        elif INFERENCE["threads_per_worker"]:
+            GlobalVariables.captioning_model.set_threads(INFERENCE["threads_per_worker"])
+        if CONFIG["embeddings"]["enabled"]:
+            with startup_phase("load embedding model"):
+                GlobalVariables.embedder = await asyncio.to_thread(load_embedder)
+        if CONFIG["startup"]["warmup"]:
+            with startup_phase("warm up"):
+                await warmup()
+    except Exception as e:  # noqa: BLE001
+        GlobalVariables.phase = f"failed: {e!s}"
+        logger.exception(f"Model service startup failed: {e!s}")
+        return
+    GlobalVariables.phase = "ready"
+    GlobalVariables.ready = True
+    logger.info(f"Model service ready after {time.perf_counter() - start:.2f}s")
+
+
+@asynccontextmanager
+async def lifespan(_app: fastapi.FastAPI) -> AsyncIterator[None]:
+    """Load the models in the background and run the batching loops for the lifetime of the app."""
+    loading = asyncio.get_running_loop().create_task(load_models())
+    batcher.start()
+    for embedding_batcher in embedding_batchers.values():
+        embedding_batcher.start()
+    yield
+    loading.cancel()
+    await batcher.stop()
+    for embedding_batcher in embedding_batchers.values():
+        await embedding_batcher.stop()
+    if GlobalVariables.inference_pool is not None:
+        GlobalVariables.inference_pool.stop()
+    if GlobalVariables.preprocessor is not None:
+        GlobalVariables.preprocessor.stop()
+
+
+app = fastapi.FastAPI(lifespan=lifespan)
+
+
+def is_ready() -> bool:
+    """Tell whether the models are loaded and warmed up and the inference workers, if any, are alive."""
+    pool = GlobalVariables.inference_pool
+    if pool is not None and pool.broken:
+        GlobalVariables.phase = "failed: an inference worker died, restart the service"
+        GlobalVariables.ready = False
+    return GlobalVariables.ready
 
 
-captioning_model = Blip()
+def require_ready() -> None:
+    """Refuse inference requests until the models are loaded and warmed up, or once the inference workers died."""
+    if not is_ready():
+        raise fastapi.HTTPException(status_code=503, detail=f"Model service not ready: {GlobalVariables.phase}")
+
+
+@app.get("/health")
+async def health() -> dict:
+    """Report that the service is up, even while the models are loading."""
+    return {"response": "okay"}
+
+
+@app.get("/ready")
+async def ready() -> fastapi.Response:
+    """Report whether the models are loaded and warmed up, with a 503 until they are or once the workers died."""
+    is_ready()
+    return JSONResponse(
+        {"response": "okay" if GlobalVariables.ready else GlobalVariables.phase, "ready": GlobalVariables.ready},
+        status_code=200 if GlobalVariables.ready else 503,
+    )
 
 
 @app.post("/generate_captions")
 async def generate_captions(batch: Images) -> dict:
     """Generate captions for the batch of images."""
+    require_ready()
     logger.info(f"Received request to generate captions for {len(batch.images)} images")
 
-    images = decode_images(batch.images)
+    try:
+        images = await asyncio.to_thread(decode_images, batch.images)
+    except ValueError as e:
+        raise fastapi.HTTPException(status_code=400, detail=str(e)) from e
     logger.debug("Images decoded successfully")
 
-    inputs = captioning_model.processor(images, return_tensors="pt").to(
-        captioning_model.device,
-    )
-    logger.debug("Processing images through BLIP processor")
+    captions = await batcher.submit(images)
+    logger.info(f"Generated {len(captions)} captions successfully")
+
+    return {"response": "okay", "captions": captions}
 
-    outputs = captioning_model.model.generate(**inputs)
-    logger.debug("Generated caption outputs")
 
-    captions = captioning_model.processor.batch_decode(outputs, skip_special_tokens=True)
+@app.post("/generate_captions/raw")
+async def generate_captions_raw(request: fastapi.Request) -> dict:
+    """Generate captions for images sent as raw uint8 pixels.
+
+    The body is the concatenation of HWC pixel buffers, their shapes are given in the
+    `X-Image-Shapes` header as `h,w,c;h,w,c`.
+    """
+    require_ready()
+    try:
+        shapes = parse_shapes(request.headers["X-Image-Shapes"])
+        images = decode_raw_images(await request.body(), shapes)
+    except (KeyError, ValueError) as e:
+        raise fastapi.HTTPException(status_code=400, detail=f"Invalid raw image payload: {e!s}") from e
+    logger.info(f"Received request to generate captions for {len(images)} raw images")
+
+    captions = await batcher.submit(images)
     logger.info(f"Generated {len(captions)} captions successfully")
 
     return {"response": "okay", "captions": captions}
 
 
+def embeddings_response(embeddings: list) -> fastapi.Response:
+    """Send embeddings as a raw float32 matrix with its shape in the `X-Embedding-Shape` header."""
+    body, shape = encode_embeddings(embeddings)
+    return fastapi.Response(
+        content=body,
+        media_type="application/octet-stream",
+        headers={"X-Embedding-Shape": shape},
+    )
+
+
+@app.post("/embed_images/raw")
+async def embed_images_raw(request: fastapi.Request) -> fastapi.Response:
+    """Embed images sent as raw uint8 pixels, see `/generate_captions/raw` for the body."""
+    if not CONFIG["embeddings"]["enabled"]:
+        raise fastapi.HTTPException(status_code=404, detail="Embeddings are disabled")
+    require_ready()
+    try:
+        shapes = parse_shapes(request.headers["X-Image-Shapes"])
+        images = decode_raw_images(await request.body(), shapes)
+    except (KeyError, ValueError) as e:
+        raise fastapi.HTTPException(status_code=400, detail=f"Invalid raw image payload: {e!s}") from e
+    logger.info(f"Received request to embed {len(images)} raw images")
+    return embeddings_response(await embedding_batchers["images"].submit(images))
+
+
+@app.post("/embed_texts")
+async def embed_texts(batch: Texts) -> fastapi.Response:
+    """Embed texts into the same space as the images."""
+    if not CONFIG["embeddings"]["enabled"]:
+        raise fastapi.HTTPException(status_code=404, detail="Embeddings are disabled")
+    require_ready()
+    return embeddings_response(await embedding_batchers["texts"].submit(batch.texts))
+
+
 if __name__ == "__main__":
     uvicorn.run("__main__:app", **CONFIG["model"])
@@ -0,0 +1,228 @@
+"""CPU inference backends of the BLIP captioning model."""
+
+import importlib.util
+import re
+from pathlib import Path
+
+import numpy as np
+import torch
+from huggingface_hub import hf_hub_download
+from huggingface_hub.utils import EntryNotFoundError
+from loguru import logger
+from PIL import Image
+from safetensors.torch import load_file
+from transformers import BlipConfig, BlipForConditionalGeneration, BlipProcessor
+from transformers.modeling_utils import no_init_weights
+
+
+def load_blip(model_name: str, token: str | None = None) -> BlipForConditionalGeneration:
+    """Load BLIP with its parameters memory-mapped from the safetensors checkpoint when there is one.
+
+    The parameters then point straight into the page cache: nothing is randomly initialized or
+    copied, pages are only read when first used, and processes loading the same file share them.
+    Checkpoints that do not map one-to-one onto the model go through `from_pretrained` instead.
+    """
+    try:
+        path = hf_hub_download(model_name, "model.safetensors", token=token)
+    except EntryNotFoundError:
+        logger.info(f"{model_name} has no safetensors checkpoint, loading it with from_pretrained")
+        return BlipForConditionalGeneration.from_pretrained(model_name, token=token)
+    with no_init_weights():
+        model = BlipForConditionalGeneration(BlipConfig.from_pretrained(model_name, token=token))
+    missing, unexpected = model.load_state_dict(load_file(path), strict=False, assign=True)
+    model.tie_weights()
+    tied = [
+        f"{name}.{key}" if name else key
+        for name, module in model.named_modules()
+        for key in getattr(module, "_tied_weights_keys", None) or []
+    ]
+    missing = [key for key in missing if not any(re.search(pattern, key) for pattern in tied)]
+    if missing or unexpected:
+        logger.warning(f"{path} does not match the model, loading it with from_pretrained")
+        return BlipForConditionalGeneration.from_pretrained(model_name, token=token)
+    return model
+
+
+class CaptionBackend:
+    """Caption images with BLIP in eager fp32 PyTorch, the reference every other backend is compared to."""
+
+    def __init__(self, model_name: str, token: str | None = None, device: str = "cpu") -> None:
+        """Load the processor and the model on `device`."""
+        self.device = device
+        self.processor = BlipProcessor.from_pretrained(model_name, token=token)
+        self.model = load_blip(model_name, token).to(device).eval()
+        self.prepare()
+
+    def prepare(self) -> None:
+        """Turn the loaded fp32 model into the one this backend runs."""
+
+    def set_threads(self, threads: int) -> None:
+        """Run inference on `threads` intra-op threads."""
+        torch.set_num_threads(threads)
+
+    def generate(self, pixel_values: torch.Tensor) -> torch.Tensor:
+        """Decode the token ids of the captions of preprocessed images."""
+        return self.model.generate(pixel_values=pixel_values)
+
+    def caption(self, images: list[Image.Image]) -> list[str]:
+        """Generate captions for a batch of images."""
+        return self.caption_pixels(self.processor(images, return_tensors="np")["pixel_values"])
+
+    def caption_pixels(self, pixel_values: np.ndarray) -> list[str]:
+        """Generate captions for a batch of already normalized NCHW float32 pixels, without copying them on the CPU."""
+        with torch.inference_mode():
+            outputs = self.generate(torch.from_numpy(pixel_values).to(self.device))
+        return self.processor.batch_decode(outputs, skip_special_tokens=True)
+
+
+class QuantizedBackend(CaptionBackend):
+    """Run the linear layers with int8 weights, activations being quantized on the fly."""
+
+    def prepare(self) -> None:
+        """Quantize the weights of every linear layer."""
+        self.model = torch.ao.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+class CompiledBackend(CaptionBackend):
+    """Run the vision encoder and the text decoder as graphs compiled by `torch.compile`.
+
+    Compilation happens on the first batches of every new shape, so the first captions are slow.
+    """
+
+    def prepare(self) -> None:
+        """Wrap the encoder and the decoder step in compiled graphs."""
+        self.model.vision_model = torch.compile(self.model.vision_model, dynamic=True)
+        self.model.text_decoder.forward = torch.compile(self.model.text_decoder.forward, dynamic=True)
+
+
+class _DecoderStep(torch.nn.Module):
+    """Logits of the BLIP text decoder for token ids and image embeddings, without a KV cache."""
+
+    def __init__(self, decoder: torch.nn.Module) -> None:
+        super().__init__()
+        self.decoder = decoder
+
+    def forward(self, input_ids: torch.Tensor, image_embeds: torch.Tensor) -> torch.Tensor:
+        return self.decoder(
+            input_ids=input_ids,
+            encoder_hidden_states=image_embeds,
+            use_cache=False,
+            return_dict=False,
+        )[0]
+
+
+class OnnxBackend(CaptionBackend):
+    """Run an ONNX Runtime export of the vision encoder and of the text decoder, decoding greedily.
+
+    The export is written to `onnx_dir` on first use and reused afterwards. Needs the `onnx` extra.
+    """
+
+    def __init__(
+        self,
+        model_name: str,
+        token: str | None = None,
+        device: str = "cpu",
+        onnx_dir: Path = Path("..", "index", "onnx"),
+    ) -> None:
+        """Load the model, exporting it first when no export exists yet."""
+        self.onnx_dir = Path(onnx_dir) / model_name.replace("/", "--")
+        super().__init__(model_name, token, device)
+
+    def prepare(self) -> None:
+        """Export the two halves of the model if needed and open an inference session for each."""
+        if importlib.util.find_spec("onnxruntime") is None:
+            msg = "the onnx backend needs onnxruntime, install the project with the `onnx` extra"
+            raise ImportError(msg)
+        encoder_path, decoder_path = self.onnx_dir / "vision_encoder.onnx", self.onnx_dir / "text_decoder.onnx"
+        if not (encoder_path.exists() and decoder_path.exists()):
+            self.export(encoder_path, decoder_path)
+        self.paths = (encoder_path, decoder_path)
+        self.set_threads(0)
+        text_config = self.model.config.text_config
+        self.bos_token_id = text_config.bos_token_id
+        self.eos_token_id = text_config.sep_token_id
+        self.pad_token_id = text_config.pad_token_id
+        self.max_length = self.model.generation_config.max_length
+        # Only the ONNX sessions are used from now on.
+        del self.model
+
+    def set_threads(self, threads: int) -> None:
+        """Open new inference sessions with `threads` intra-op threads (0 lets ONNX Runtime decide).
+
+        Sessions own their thread pools, which do not survive a fork, so forked workers call this too.
+        """
+        import onnxruntime  # noqa: PLC0415
+
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = threads
+        providers = ["CPUExecutionProvider"]
+        self.encoder, self.decoder = (
+            onnxruntime.InferenceSession(path, options, providers=providers) for path in self.paths
+        )
+
+    def export(self, encoder_path: Path, decoder_path: Path) -> None:
+        """Export the vision encoder and one step of the text decoder with dynamic batch and length axes."""
+        logger.info(f"Exporting BLIP to ONNX in {self.onnx_dir}")
+        self.onnx_dir.mkdir(parents=True, exist_ok=True)
+        size = self.processor.image_processor.size["height"]
+        pixel_values = torch.zeros(2, 3, size, size)
+        with torch.no_grad():
+            image_embeds = self.model.vision_model(pixel_values=pixel_values)[0]
+        torch.onnx.export(
+            self.model.vision_model,
+            (pixel_values,),
+            encoder_path,
+            input_names=["pixel_values"],
+            output_names=["image_embeds"],
+            dynamic_axes={"pixel_values": {0: "batch"}, "image_embeds": {0: "batch"}},
+            opset_version=17,
+            dynamo=False,
+        )
+        torch.onnx.export(
+            _DecoderStep(self.model.text_decoder),
+            (torch.ones(2, 3, dtype=torch.int64), image_embeds),
+            decoder_path,
+            input_names=["input_ids", "image_embeds"],
+            output_names=["logits"],
+            dynamic_axes={
+                "input_ids": {0: "batch", 1: "length"},
+                "image_embeds": {0: "batch"},
+                "logits": {0: "batch", 1: "length"},
+            },
+            opset_version=17,
+            dynamo=False,
+        )
+
+    def generate(self, pixel_values: torch.Tensor) -> torch.Tensor:
+        """Encode the images once, then extend every caption by its most likely next token until all end."""
+        image_embeds = self.encoder.run(None, {"pixel_values": pixel_values.numpy()})[0]
+        ids = np.full((len(image_embeds), 1), self.bos_token_id, dtype=np.int64)
+        done = np.zeros(len(image_embeds), dtype=bool)
+        while ids.shape[1] < self.max_length and not done.all():
+            logits = self.decoder.run(None, {"input_ids": ids, "image_embeds": image_embeds})[0]
+            next_ids = np.where(done, self.pad_token_id, logits[:, -1].argmax(axis=-1))
+            ids = np.concatenate([ids, next_ids[:, None]], axis=1)
+            done |= next_ids == self.eos_token_id
+        return torch.from_numpy(ids)
+
+
+BACKENDS: dict[str, type[CaptionBackend]] = {
+    "eager": CaptionBackend,
+    "int8": QuantizedBackend,
+    "compiled": CompiledBackend,
+    "onnx": OnnxBackend,
+}
+
+
+def load_backend(name: str, model_name: str, token: str | None = None, **options: object) -> CaptionBackend:
+    """Load the captioning model with the backend called `name`, falling back to eager fp32 on a GPU."""
+    device = "cuda" if torch.cuda.is_available() and torch.cuda.device_count() > 0 else "cpu"
+    if name not in BACKENDS:
+        msg = f"unknown captioning backend {name!r}, expected one of {', '.join(BACKENDS)}"
+        raise ValueError(msg)
+    if device != "cpu" and name != "eager":
+        logger.warning(f"The {name} backend only runs on the CPU, using eager on {device}")
+        name = "eager"
+    logger.info(f"Loading {model_name} with the {name} backend on {device}")
+    return BACKENDS[name](model_name, token, device, **(options if name == "onnx" else {}))
@@ -0,0 +1,172 @@
+"""Dynamic batching of model requests."""
+
+import asyncio
+import contextlib
+import itertools
+from collections.abc import Awaitable, Callable
+from concurrent.futures import ThreadPoolExecutor
+
+from loguru import logger
+from PIL import Image
+
+# An input of a batch, the future its output is delivered to and the request it came with.
+Item = tuple[Image.Image, asyncio.Future, int]
+
+
+class MicroBatcher:
+    """Merge inputs (images, or texts) from concurrent requests into batches for the model.
+
+    A batch is closed once it holds `max_batch_size` inputs or `max_wait` seconds after its first
+    input arrived. Inference runs on dedicated threads so the event loop keeps accepting requests,
+    with up to `concurrency` batches in flight, and each caller only gets the outputs (captions, or
+    embeddings) of its own inputs back. With `prepare`, every batch is first turned into model
+    inputs by that coroutine, while the previous batches still run, and `infer` gets its result;
+    `release` is called with it once the batch is done. When a batch merging several requests
+    fails, every request is retried on its own so one bad input only fails the request it came with.
+    """
+
+    def __init__(  # noqa: PLR0913
+        self,
+        infer: Callable[[list[Image.Image]], list[str]] | Callable[[list], list],
+        max_batch_size: int,
+        max_wait: float,
+        *,
+        concurrency: int = 1,
+        prepare: Callable[[list], Awaitable[object]] | None = None,
+        release: Callable[[object], None] | None = None,
+    ) -> None:
+        """Store the inference function and batching limits."""
+        self.infer = infer
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.concurrency = concurrency
+        self.prepare = prepare
+        self.release = release
+        self.queue: asyncio.Queue[Item] = asyncio.Queue()
+        self.requests = itertools.count()
+        self.executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="inference")
+        self.task: asyncio.Task | None = None
+        self.running: set[asyncio.Task] = set()
+
+    def start(self) -> None:
+        """Start collecting batches on the running event loop."""
+        self.task = asyncio.get_running_loop().create_task(self._run())
+
+    async def stop(self) -> None:
+        """Stop the batching loop and the inference threads."""
+        for task in [self.task, *self.running]:
+            if task is not None:
+                task.cancel()
+                with contextlib.suppress(asyncio.CancelledError):
+                    await task
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    async def submit(self, images: list[Image.Image]) -> list[str]:
+        """Queue images and wait for their captions."""
+        loop = asyncio.get_running_loop()
+        request = next(self.requests)
+        futures = []
+        for image in images:
+            future = loop.create_future()
+            futures.append(future)
+            self.queue.put_nowait((image, future, request))
+        return list(await asyncio.gather(*futures))
+
+    async def _collect(self) -> list[Item]:
+        """Wait for the first image, then fill the batch until it is full or its deadline passes."""
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            if not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+                continue
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+            except TimeoutError:
+                break
+        return [item for item in batch if not item[1].done()]
+
+    async def _run(self) -> None:
+        """Form batches forever.
+
+        Without `prepare`, a batch only starts to fill once a slot for running it is free. With it,
+        the next batch is collected and prepared while every slot is busy.
+        """
+        slots = asyncio.Semaphore(self.concurrency)
+        while True:
+            if self.prepare is None:
+                await slots.acquire()
+            batch = await self._collect()
+            if not batch:
+                if self.prepare is None:
+                    slots.release()
+                continue
+            inputs = [image for image, _, _ in batch]
+            if self.prepare is not None:
+                try:
+                    inputs = await self.prepare(inputs)
+                except Exception as e:  # noqa: BLE001
+                    self._track(asyncio.get_running_loop().create_task(self._isolate(batch, e)))
+                    continue
+                await slots.acquire()
+            task = asyncio.get_running_loop().create_task(self._infer(batch, inputs))
+            self._track(task)
+            task.add_done_callback(lambda _: slots.release())
+
+    def _track(self, task: asyncio.Task) -> None:
+        """Keep a reference to a running task until it is done, so `stop` can cancel it."""
+        self.running.add(task)
+        task.add_done_callback(self.running.discard)
+
+    async def _infer(self, batch: list[Item], inputs: object, *, isolate: bool = True) -> None:
+        """Run one batch and resolve the futures of its images, see `_isolate` for failures."""
+        logger.debug(f"Running a batch of {len(batch)} images")
+        try:
+            captions = await asyncio.get_running_loop().run_in_executor(self.executor, self.infer, inputs)
+        except Exception as e:  # noqa: BLE001
+            error = e
+        else:
+            error = None
+        finally:
+            if self.release is not None:
+                self.release(inputs)
+        if error is not None and isolate:
+            await self._isolate(batch, error)
+            return
+        if error is not None:
+            self._fail(batch, error)
+            return
+        for (_, future, _), caption in zip(batch, captions, strict=True):
+            if not future.done():
+                future.set_result(caption)
+
+    async def _isolate(self, batch: list[Item], error: Exception) -> None:
+        """Retry every request of a failed batch on its own, so the error only reaches the requests that cause it."""
+        requests: dict[int, list[Item]] = {}
+        for item in batch:
+            requests.setdefault(item[2], []).append(item)
+        if len(requests) == 1:
+            self._fail(batch, error)
+            return
+        logger.warning(f"A batch of {len(requests)} requests failed ({error!s}), retrying them one by one")
+        for items in requests.values():
+            inputs = [image for image, _, _ in items]
+            if self.prepare is not None:
+                try:
+                    inputs = await self.prepare(inputs)
+                except Exception as e:  # noqa: BLE001
+                    self._fail(items, e)
+                    continue
+            await self._infer(items, inputs, isolate=False)
+
+    @staticmethod
+    def _fail(batch: list[Item], error: Exception) -> None:
+        """Pass the error of a batch on to the callers of its images."""
+        logger.opt(exception=error).error(f"Batch inference failed: {error!s}")
+        for _, future, _ in batch:
+            if not future.done():
+                future.set_exception(error)
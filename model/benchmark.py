@@ -0,0 +1,118 @@
+"""Benchmark of the captioning backends on a fixed image set."""
+
+import argparse
+import gc
+import time
+from pathlib import Path
+
+import numpy as np
+import yaml
+from backends import BACKENDS, load_backend
+from loguru import logger
+from PIL import Image
+
+IMAGE_SUFFIXES = {".jpg", ".jpeg", ".png", ".webp", ".bmp"}
+
+
+def load_images(directory: Path, limit: int) -> list[Image.Image]:
+    """Load the first `limit` images of a directory, in name order so every run sees the same set."""
+    paths = sorted(path for path in directory.iterdir() if path.suffix.lower() in IMAGE_SUFFIXES)[:limit]
+    images = []
+    for path in paths:
+        with Image.open(path) as image:
+            images.append(image.convert("RGB"))
+    return images
+
+
+def word_overlap(caption: str, reference: str) -> float:
+    """Jaccard similarity of the words of two captions."""
+    words, reference_words = set(caption.split()), set(reference.split())
+    return len(words & reference_words) / len(words | reference_words) if words | reference_words else 1.0
+
+
+def run(  # noqa: PLR0913
+    name: str,
+    model_name: str,
+    token: str | None,
+    images: list[Image.Image],
+    *,
+    batch_size: int,
+    repeats: int,
+    options: dict,
+) -> tuple[dict, list[str]]:
+    """Load a backend, caption the images `repeats` times after a warmup batch and time every batch."""
+    start = time.perf_counter()
+    backend = load_backend(name, model_name, token, **options)
+    load_seconds = time.perf_counter() - start
+    batches = [images[i : i + batch_size] for i in range(0, len(images), batch_size)]
+    backend.caption(batches[0])
+    latencies = []
+    captions = []
+    for _ in range(repeats):
+        captions = []
+        for batch in batches:
+            start = time.perf_counter()
+            captions.extend(backend.caption(batch))
+            latencies.append(time.perf_counter() - start)
+    del backend
+    gc.collect()
+    return {
+        "backend": name,
+        "load_s": load_seconds,
+        "images_per_s": len(images) * repeats / sum(latencies),
+        "p50_ms": float(np.percentile(latencies, 50)) * 1000,
+        "p95_ms": float(np.percentile(latencies, 95)) * 1000,
+    }, captions
+
+
+def main() -> None:
+    """Compare the throughput, batch latency and captions of each backend against eager fp32."""
+    with Path.open(Path("..", "config.yaml")) as config_file:
+        config = yaml.safe_load(config_file)
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--backends", nargs="+", choices=list(BACKENDS), default=list(BACKENDS))
+    parser.add_argument("--images", type=Path, default=Path("..", "data", "images"))
+    parser.add_argument("--limit", type=int, default=32, help="number of images captioned per repeat")
+    parser.add_argument("--batch-size", type=int, default=config["captioning"]["max_batch_size"])
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    token_path = Path("..", "API_KEY.yaml")
+    token = yaml.safe_load(token_path.read_text())["HF_TOKEN"] if token_path.exists() else None
+    model_name = config["index"]["model_version"]
+    options = {"onnx_dir": Path(config["captioning"]["onnx_dir"])}
+    images = load_images(args.images, args.limit)
+    logger.info(f"Benchmarking {', '.join(args.backends)} on {len(images)} images in batches of {args.batch_size}")
+
+    reference = None
+    rows = []
+    for name in ["eager", *(name for name in args.backends if name != "eager")]:
+        row, captions = run(
+            name,
+            model_name,
+            token,
+            images,
+            batch_size=args.batch_size,
+            repeats=args.repeats,
+            options=options,
+        )
+        if reference is None:
+            reference = captions
+        row["exact_match"] = float(np.mean([a == b for a, b in zip(captions, reference, strict=True)]))
+        row["word_overlap"] = float(np.mean([word_overlap(a, b) for a, b in zip(captions, reference, strict=True)]))
+        if name in args.backends:
+            rows.append(row)
+        logger.info(f"{name}: {row}")
+
+    header = f"{'backend':<10}{'load s':>9}{'images/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'exact':>8}{'overlap':>9}"
+    lines = [header]
+    lines.extend(
+        f"{row['backend']:<10}{row['load_s']:>9.1f}{row['images_per_s']:>10.2f}{row['p50_ms']:>10.0f}"
+        f"{row['p95_ms']:>10.0f}{row['exact_match']:>8.2f}{row['word_overlap']:>9.2f}"
+        for row in rows
+    )
+    logger.info("Caption agreement is measured against eager fp32\n" + "\n".join(lines))
+
+
+if __name__ == "__main__":
+    main()
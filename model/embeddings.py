@@ -0,0 +1,43 @@
+"""CLIP embeddings of images and texts."""
+
+import numpy as np
+import torch
+from loguru import logger
+from PIL import Image
+from transformers import CLIPModel, CLIPProcessor
+
+
+class Embedder:
+    """Embed images and texts into the same space, as unit-norm float32 vectors."""
+
+    def __init__(self, model_name: str, token: str | None = None) -> None:
+        """Load the CLIP model on the CPU."""
+        logger.info(f"Loading embedding model {model_name}")
+        self.processor = CLIPProcessor.from_pretrained(model_name, token=token)
+        self.model = CLIPModel.from_pretrained(model_name, token=token).eval()
+        self.dim = self.model.config.projection_dim
+        logger.info("Embedding model loaded successfully")
+
+    @staticmethod
+    def normalize(features: torch.Tensor) -> list[np.ndarray]:
+        """Scale each row to unit length and split the batch into vectors."""
+        features = torch.nn.functional.normalize(features, dim=-1)
+        return list(features.to(torch.float32).numpy())
+
+    def embed_images(self, images: list[Image.Image]) -> list[np.ndarray]:
+        """Embed a batch of images."""
+        inputs = self.processor(images=images, return_tensors="pt")
+        with torch.inference_mode():
+            return self.normalize(self.model.get_image_features(**inputs))
+
+    def embed_texts(self, texts: list[str]) -> list[np.ndarray]:
+        """Embed a batch of texts."""
+        inputs = self.processor(text=texts, return_tensors="pt", padding=True, truncation=True)
+        with torch.inference_mode():
+            return self.normalize(self.model.get_text_features(**inputs))
+
+
+def encode_embeddings(embeddings: list[np.ndarray]) -> tuple[bytes, str]:
+    """Serialize vectors as a raw float32 matrix and its `n,d` shape header."""
+    matrix = np.stack(embeddings).astype(np.float32, copy=False) if embeddings else np.empty((0, 0), np.float32)
+    return matrix.tobytes(), f"{matrix.shape[0]},{matrix.shape[1]}"
@@ -0,0 +1,73 @@
+"""Parallel decoding and normalization of images into reusable model input buffers."""
+
+import asyncio
+import mmap
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+
+class Preprocessor:
+    """Turn batches of images into normalized NCHW float32 pixels, the input of the BLIP vision encoder.
+
+    Every image of a batch is decoded, resized and normalized on its own thread of a pool, straight
+    into a row of one of `buffers` preallocated batch buffers, so that preparing a batch overlaps
+    with inference on the previous ones and nothing is allocated per batch. The buffers are
+    anonymous shared mappings: inference workers forked afterwards read the same memory instead of
+    receiving a copy of every batch.
+    """
+
+    def __init__(self, image_processor: object, max_batch_size: int, buffers: int, workers: int) -> None:
+        """Take the resize and normalization settings from the Hugging Face image processor."""
+        self.size = (image_processor.size["width"], image_processor.size["height"])
+        self.resample = Image.Resampling(int(image_processor.resample))
+        std = np.asarray(image_processor.image_std, dtype=np.float32).reshape(3, 1, 1)
+        mean = np.asarray(image_processor.image_mean, dtype=np.float32).reshape(3, 1, 1)
+        # Rescaling then normalizing is folded into one multiply and one subtract per pixel.
+        self.factor = np.float32(image_processor.rescale_factor) / std
+        self.offset = mean / std
+        shape = (max_batch_size, 3, self.size[1], self.size[0])
+        nbytes = int(np.prod(shape)) * np.dtype(np.float32).itemsize
+        self.buffers = [np.ndarray(shape, dtype=np.float32, buffer=mmap.mmap(-1, nbytes)) for _ in range(buffers)]
+        self.free: asyncio.Queue[int] = asyncio.Queue()
+        for index in range(buffers):
+            self.free.put_nowait(index)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="preprocess")
+
+    def fill(self, index: int, row: int, image: Image.Image) -> None:
+        """Resize and normalize an image into a row of a buffer."""
+        image = image if image.mode == "RGB" else image.convert("RGB")
+        pixels = np.asarray(image.resize(self.size, self.resample)).transpose(2, 0, 1)
+        target = self.buffers[index][row]
+        np.multiply(pixels, self.factor, out=target)
+        target -= self.offset
+
+    async def prepare(self, images: list[Image.Image]) -> tuple[int, int]:
+        """Fill the next free buffer with a batch, returns the buffer index and the batch size."""
+        index = await self.free.get()
+        loop = asyncio.get_running_loop()
+        try:
+            await asyncio.gather(
+                *(
+                    loop.run_in_executor(self.executor, self.fill, index, row, image)
+                    for row, image in enumerate(images)
+                ),
+            )
+        except BaseException:
+            self.release((index, len(images)))
+            raise
+        return index, len(images)
+
+    def pixels(self, prepared: tuple[int, int]) -> np.ndarray:
+        """View of the pixels of a prepared batch."""
+        index, size = prepared
+        return self.buffers[index][:size]
+
+    def release(self, prepared: tuple[int, int]) -> None:
+        """Hand the buffer of a batch that went through the model back for the next batches."""
+        self.free.put_nowait(prepared[0])
+
+    def stop(self) -> None:
+        """Stop the preprocessing threads."""
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -3,6 +3,7 @@
 import base64
 from io import BytesIO
 
+import numpy as np
 from loguru import logger
 from PIL import Image
 from pydantic import BaseModel
@@ -14,14 +15,51 @@ class Images(BaseModel):
     images: list[str]
 
 
-def decode_images(images: Images) -> list[Image.Image]:
-    """Convert Base64 strings to PIL Images."""
+class Texts(BaseModel):
+    """Texts to embed."""
+
+    texts: list[str]
+
+
+def decode_images(images: list[str]) -> list[Image.Image]:
+    """Convert Base64 strings to fully decoded RGB PIL Images, raising ValueError on the first invalid one.
+
+    Images are decoded here, per request, so a corrupt upload is refused on its own instead of
+    failing the batch it would be merged into.
+    """
     pil_images = []
-    for img_str in images:
+    for position, img_str in enumerate(images):
         try:
-            img_bytes = base64.b64decode(img_str)
-            img = Image.open(BytesIO(img_bytes))
-            pil_images.append(img)
-        except (Exception, BaseExceptionGroup):
-            logger.error(f"Error decoding image: {img_str}")
+            with Image.open(BytesIO(base64.b64decode(img_str))) as img:
+                pil_images.append(img.convert("RGB"))
+        except (Exception, BaseExceptionGroup) as e:
+            logger.error(f"Error decoding image {position}: {e!s}")
+            error = f"Image {position} could not be decoded: {e!s}"
+            raise ValueError(error) from e
+    return pil_images
+
+
+def parse_shapes(header: str) -> list[tuple[int, int, int]]:
+    """Parse an `X-Image-Shapes` header of the form `h,w,c;h,w,c`."""
+    shapes = []
+    for shape in header.split(";"):
+        height, width, channels = (int(dim) for dim in shape.split(","))
+        shapes.append((height, width, channels))
+    return shapes
+
+
+def decode_raw_images(body: bytes, shapes: list[tuple[int, int, int]]) -> list[Image.Image]:
+    """Split a body of concatenated uint8 HWC pixel buffers into PIL Images without copying it."""
+    expected = sum(height * width * channels for height, width, channels in shapes)
+    if expected != len(body):
+        error = f"Body has {len(body)} bytes but the shapes describe {expected}"
+        raise ValueError(error)
+    buffer = np.frombuffer(body, dtype=np.uint8)
+    pil_images = []
+    offset = 0
+    for height, width, channels in shapes:
+        size = height * width * channels
+        pixels = buffer[offset : offset + size].reshape(height, width, channels)
+        pil_images.append(Image.fromarray(pixels.squeeze(axis=2) if channels == 1 else pixels))
+        offset += size
     return pil_images
@@ -0,0 +1,112 @@
+"""Inference worker processes sharing the weights of a loaded model."""
+
+import contextlib
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import numpy as np
+import torch
+from backends import CaptionBackend
+from loguru import logger
+
+# Set in the service process right before forking, the workers inherit them with the loaded weights.
+_backend: CaptionBackend | None = None
+_buffers: list[np.ndarray] = []
+
+
+def core_slices(workers: int, threads: int = 0) -> list[list[int]]:
+    """Split the cores this process may run on into one slice per worker, of `threads` cores each.
+
+    With `threads` 0 the cores are shared out evenly. Slices wrap around when they ask for more
+    cores than there are.
+    """
+    cores = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count() or 1))
+    threads = min(threads or max(len(cores) // workers, 1), len(cores))
+    return [[cores[(worker * threads + i) % len(cores)] for i in range(threads)] for worker in range(workers)]
+
+
+def _pin(slices: multiprocessing.Queue) -> None:
+    """Pin a freshly forked worker to the next free slice of cores and size its thread pools to it."""
+    cores = slices.get()
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    with contextlib.suppress(RuntimeError):
+        # Fails once inter-op work already ran in this process, the default is kept then.
+        torch.set_num_interop_threads(1)
+    _backend.set_threads(len(cores))
+    logger.info(f"Inference worker {os.getpid()} pinned to cores {cores}")
+
+
+def _caption_buffer(index: int, size: int) -> list[str]:
+    """Caption the first `size` rows of a shared input buffer in a worker."""
+    return _backend.caption_pixels(_buffers[index][:size])
+
+
+def _pid() -> int:
+    """Identify a worker once it is initialized."""
+    return os.getpid()
+
+
+class InferencePool:
+    """Caption batches in `workers` processes forked from the process that loaded the model.
+
+    The weights are loaded once and inherited copy-on-write, and since inference never writes to
+    them their pages stay shared, so resident memory barely grows with the number of workers. Each
+    worker runs on its own slice of cores with as many intra-op threads as it has cores, so
+    concurrent batches do not compete for the same cores. Backends whose runtime state does not
+    survive a fork (ONNX Runtime sessions) rebuild it in every worker.
+    """
+
+    def __init__(
+        self,
+        backend: CaptionBackend,
+        workers: int,
+        threads: int = 0,
+        buffers: list[np.ndarray] | None = None,
+    ) -> None:
+        """Store the loaded backend, how to split the cores and the shared input buffers, if any."""
+        self.backend = backend
+        self.buffers = buffers or []
+        self.workers = workers
+        self.threads = threads
+        self.executor: ProcessPoolExecutor | None = None
+        self.broken = False
+
+    def start(self) -> None:
+        """Fork every worker now, before the service starts threads or runs any inference."""
+        global _backend, _buffers
+        _backend, _buffers = self.backend, self.buffers
+        context = multiprocessing.get_context("fork")
+        slices = context.Queue()
+        for cores in core_slices(self.workers, self.threads):
+            slices.put(cores)
+        self.executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=context,
+            initializer=_pin,
+            initargs=(slices,),
+        )
+        for future in [self.executor.submit(_pid) for _ in range(self.workers)]:
+            future.result()
+        logger.info(f"Started {self.workers} inference workers")
+
+    def caption_buffer(self, prepared: tuple[int, int]) -> list[str]:
+        """Caption a batch prepared in one of the shared buffers, see `Preprocessor`.
+
+        A worker that dies (killed for memory, crashed in native code) breaks the whole pool, which
+        is then flagged `broken` so the service reports itself not ready instead of failing every batch.
+        """
+        try:
+            return self.executor.submit(_caption_buffer, *prepared).result()
+        except BrokenProcessPool:
+            if not self.broken:
+                logger.error("An inference worker died, the inference pool is broken")
+            self.broken = True
+            raise
+
+    def stop(self) -> None:
+        """Stop the workers."""
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
@@ -5,37 +5,63 @@ from __future__ import (
 )
 
 import asyncio
+import bisect
 import io
 import os
 import shutil
+import subprocess
 import sys
-from collections import OrderedDict
-from functools import lru_cache
+import threading
+import time
+import urllib.parse
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Literal
 
 import fastapi
+import numpy as np
+import orjson
 import tantivy
 import yaml
+from caption_cache import CaptionCache, perceptual_hash
+from catalog import MediaCatalog
 from fastapi import File, UploadFile
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.staticfiles import StaticFiles
+from fastapi.responses import JSONResponse
+from frames import AdaptiveSampler
+from index_store import SCHEMA_VERSION, IndexingService, IndexStore, materialize_hits
+from jobs import JobRunner, JobStore, media_type
 from loguru import logger
+from manifest import Manifest, entry_of, path_of, source_of
 from PIL import Image
-from request_models import Docs, Query  # noqa: TC002
-from utils import ACCEPTED, IMAGES_PATH, VIDEOS_PATH, Blip, image_adder, video_adder
+from pipeline import FileState, IngestionPipeline
+from previews import PreviewStore, remove_unreferenced
+from query_cache import QueryCache, SharedQueryCache, cache_key
+from request_models import Docs, Query
+from static_files import CachingStaticFiles
+from utils import IMAGES_PATH, VIDEOS_PATH, Blip
+from vector_store import VectorStore, reciprocal_rank_fusion
+from watcher import MediaWatcher
 
 parent_dir = Path(__file__).resolve().parent.parent
 sys.path.append(str(parent_dir))
 
 if TYPE_CHECKING:
-    from fastapi.responses import Response
-    from starlette.types import Scope
+    from collections.abc import Callable, Iterator
 
 from unified_logging.config_types import LoggingConfigs  # noqa: E402
 from unified_logging.logging_client import setup_network_logger_client  # noqa: E402
 
 INDEX_PATH = Path("..", "index", "data")
+MANIFEST_PATH = Path("..", "index", "manifest.sqlite3")
+CAPTION_CACHE_PATH = Path("..", "index", "caption_cache.sqlite3")
+QUERY_CACHE_PATH = Path("..", "index", "query_cache.sqlite3")
+JOBS_PATH = Path("..", "index", "jobs.sqlite3")
+UPLOADS_PATH = Path("..", "index", "uploads")
+PREVIEWS_PATH = Path("..", "index", "previews")
+VECTORS_PATH = Path("..", "index", "vectors")
 LOGGING_CONFIG_PATH = Path("..", "unified_logging/logging_config.toml")
 
 app = fastapi.FastAPI()
@@ -47,28 +73,6 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-class CachingStaticFiles(StaticFiles):
-    """Caaches Static Files."""
-
-    def __init__(self, cache_size:int=128, *args, **kwargs) -> None:
-        """Initialize the CachingStaticFiles cache."""
-        super().__init__(*args, **kwargs)
-        self.cache = OrderedDict()
-        self.cachesize = cache_size
-    async def get_response(self, path: str, scope:Scope) -> Response:
-        """Get cached response."""
-        if path in self.cache:
-            return self.cache[path]
-        response = await super().get_response(path, scope)
-        if len(self.cache) >= self.cachesize:
-            self.cache.popitem(last=True)
-        if response.status_code == ACCEPTED:
-            self.cache[path] = response
-        return response
-
-app.mount("/images", CachingStaticFiles(directory=IMAGES_PATH, cache_size=128), name="static")
-app.mount("/videos", CachingStaticFiles(directory=VIDEOS_PATH, cache_size=512), name="static")
-
 with Path.open(Path("..", "config.yaml")) as config_file:
     CONFIG = yaml.safe_load(config_file)
 
@@ -77,166 +81,652 @@ if LOGGING_CONFIG_PATH.exists():
     logging_configs = LoggingConfigs.load_from_path(LOGGING_CONFIG_PATH)
     setup_network_logger_client(logging_configs, logger)
 
+STATIC_FILES = {
+    "images": CachingStaticFiles(
+        directory=IMAGES_PATH,
+        max_bytes=CONFIG["static_cache"]["images_max_bytes"],
+        max_file_bytes=CONFIG["static_cache"]["max_file_bytes"],
+    ),
+    "videos": CachingStaticFiles(
+        directory=VIDEOS_PATH,
+        max_bytes=CONFIG["static_cache"]["videos_max_bytes"],
+        max_file_bytes=CONFIG["static_cache"]["max_file_bytes"],
+    ),
+}
+for name, static_files in STATIC_FILES.items():
+    app.mount(f"/{name}", static_files, name=name)
+PREVIEWS = PreviewStore(PREVIEWS_PATH, **CONFIG["previews"])
+STATIC_FILES["previews"] = CachingStaticFiles(
+    directory=PREVIEWS_PATH,
+    check_dir=False,
+    max_bytes=CONFIG["static_cache"]["previews_max_bytes"],
+    max_file_bytes=CONFIG["static_cache"]["max_file_bytes"],
+)
+
 MODEL = Blip(config=CONFIG)
+MODEL_VERSION = CONFIG["index"]["model_version"]
+# Backends caption slightly differently, so captions are tied to the backend that produced them.
+CAPTIONER = f"{MODEL_VERSION}#{CONFIG['captioning']['backend']}"
+EMBEDDINGS = CONFIG["embeddings"]
+# Files are re-ingested when the captioning model or backend changes, and also when the signatures do.
+INGEST_VERSION = CAPTIONER + "+dhash" + (f"+{EMBEDDINGS['model']}" if EMBEDDINGS["enabled"] else "")
+MANIFEST = Manifest(MANIFEST_PATH)
+CAPTION_CACHE = CaptionCache(
+    CAPTION_CACHE_PATH,
+    model_key=f"{CAPTIONER}@{MODEL.input_size}",
+    max_entries=CONFIG["caption_cache"]["max_entries"],
+)
+QUERY_CACHE = QueryCache(
+    max_size=CONFIG["query_cache"]["max_size"],
+    ttl=CONFIG["query_cache"]["ttl"],
+    shared=SharedQueryCache(
+        QUERY_CACHE_PATH,
+        max_size=CONFIG["query_cache"]["max_size"],
+        ttl=CONFIG["query_cache"]["ttl"],
+    )
+    if CONFIG["query_cache"]["shared"]
+    else None,
+)
+JOBS = JobStore(JOBS_PATH)
+# Perceptual hashes are always kept for /search_by_image, embeddings only when enabled.
+VECTORS = VectorStore(
+    VECTORS_PATH,
+    dim=EMBEDDINGS["dim"] if EMBEDDINGS["enabled"] else 0,
+    dtype=EMBEDDINGS["dtype"],
+    model=EMBEDDINGS["model"] if EMBEDDINGS["enabled"] else "",
+    nlist=EMBEDDINGS["nlist"],
+    nprobe=EMBEDDINGS["nprobe"],
+    ivf_min_rows=EMBEDDINGS["ivf_min_rows"],
+)
+CATALOG = MediaCatalog({"image": IMAGES_PATH, "video": VIDEOS_PATH})
+
+SYNC_LOCK = threading.Lock()
+# Shared by the main process and the workers it spawns, /ready compares it with the run the last startup sync was for.
+RUN_ID = os.environ.setdefault("SEARCHER_RUN_ID", uuid.uuid4().hex)
+QUERY_POOL = ThreadPoolExecutor(max_workers=CONFIG["batch_query"]["workers"], thread_name_prefix="query")
 
 
 class GlobalVariables:
     """Store Global Variables."""
 
-    index: tantivy.Index | None = None
+    index: IndexStore = IndexStore(INDEX_PATH)
+    indexer: IndexingService = IndexingService(index, **CONFIG["indexing"], on_commit=QUERY_CACHE.clear)
 
 
 def initialize_index() -> bool:
-    """Initialize the search index, optionally rebuilding from scratch."""
-    if Path.exists(INDEX_PATH):
-        logger.info(f"Removing existing index at {INDEX_PATH}")
-        shutil.rmtree(INDEX_PATH)
-
-    if not Path.exists(INDEX_PATH):
-        logger.info(f"Creating new index directory at {INDEX_PATH}")
-        Path.mkdir(INDEX_PATH, parents=True)
-
-        # Create schema and initialize index
-        schema_builder = tantivy.SchemaBuilder()
-        schema_builder.add_text_field("caption", stored=True, tokenizer_name="en_stem")
-        schema_builder.add_text_field("filename", stored=True)
-        schema_builder.add_text_field("type", stored=True)
-        schema_builder.add_integer_field("timestamp", stored=True)
-        schema = schema_builder.build()
-        GlobalVariables.index = tantivy.Index(schema=schema, path=INDEX_PATH.as_posix())
-        return True
-    # Use existing index
-    set_index()
-    return False
+    """Open the persistent search index, rebuilding it from scratch when its schema is outdated."""
+    rebuild = MANIFEST.get_meta("schema_version") != SCHEMA_VERSION
+    GlobalVariables.index.open(rebuild=rebuild)
+    if rebuild:
+        MANIFEST.clear()
+        MANIFEST.set_meta("schema_version", SCHEMA_VERSION)
+    return rebuild
+
+
+def sync_index() -> int:
+    """Bring the index up to date with the images and videos on disk.
+
+    Only files that are new or changed since the last sync are captioned, and the documents of
+    deleted files are removed. Returns the number of files ingested.
+    """
+    with SYNC_LOCK:
+        diff = MANIFEST.diff({"image": IMAGES_PATH, "video": VIDEOS_PATH}, model_version=INGEST_VERSION)
+        CATALOG.update(added=[path_of(entry.source) for entry in diff.new], removed=map(path_of, diff.deleted))
+        if not (diff.to_ingest or diff.deleted or diff.touched):
+            return 0
+        logger.info(
+            f"Manifest diff: {len(diff.new)} new, {len(diff.changed)} changed, "
+            f"{len(diff.deleted)} deleted, {len(diff.touched)} touched",
+        )
+        GlobalVariables.indexer.delete_sources(diff.to_delete)
+        VECTORS.delete_sources(diff.to_delete)
+        MANIFEST.upsert(diff.touched)
+        pending = {entry.source: entry for entry in diff.to_ingest}
+        logger.info(f"Starting to process {len(pending)} images and videos")
+        captioned: set[str] = set()
+        set_sync_progress(running=True, files=len(pending), captioned=0)
+
+        def on_progress(state: FileState) -> None:
+            if state.decoded and state.captioned == state.frames and state.source not in captioned:
+                captioned.add(state.source)
+                set_sync_progress(running=True, files=len(pending), captioned=len(captioned))
+
+        try:
+            ingested = make_pipeline(on_progress).run(
+                [(path_of(entry.source), entry.type, entry.sha256) for entry in pending.values()],
+            )
+        finally:
+            set_sync_progress(running=False, files=len(pending), captioned=len(captioned))
+        GlobalVariables.indexer.finish_bulk_load()
+        VECTORS.maintain()
+        MANIFEST.remove(diff.deleted)
+        MANIFEST.upsert(pending[source_of(path)] for path in ingested)
+        if diff.changed or diff.deleted:
+            digests = {entry.sha256 for entry in MANIFEST.entries().values()}
+            removed = remove_unreferenced(PREVIEWS_PATH, digests) if PREVIEWS_PATH.exists() else 0
+            logger.info(f"Removed {removed} previews of changed or deleted files")
+        logger.info(f"Data loading completed successfully, {len(ingested)}/{len(pending)} files ingested")
+        return len(ingested)
+
+
+def set_sync_progress(*, running: bool, files: int, captioned: int) -> None:
+    """Record the progress of the running sync in the manifest, where every worker can read it for `/sync`."""
+    MANIFEST.set_meta("sync", orjson.dumps({"running": running, "files": files, "captioned": captioned}).decode())
+
+
+def make_pipeline(on_progress: Callable[[FileState], None] | None = None) -> IngestionPipeline:
+    """Create an ingestion pipeline that adds documents to the shared index writer."""
+    return IngestionPipeline(
+        add_fn=add_multiple,
+        model=MODEL,
+        sampler=AdaptiveSampler(**CONFIG["sampling"]),
+        caption_cache=CAPTION_CACHE,
+        previews=PREVIEWS,
+        vectors=VECTORS,
+        on_progress=on_progress,
+        **CONFIG["ingestion"],
+    )
+
+
+def run_jobs(jobs: list[dict]) -> None:
+    """Move uploaded files into the media directories and ingest them, reporting progress per job.
+
+    The sync lock is held throughout so the watcher finds the moved files already in the manifest.
+    Files that could not be ingested are deleted again, so they are neither listed nor retried by syncs.
+    """
+    with SYNC_LOCK:
+        pending = {}
+        for job in jobs:
+            staged = Path(job["staged_path"])
+            root = IMAGES_PATH if job["type"] == "image" else VIDEOS_PATH
+            target = root / staged.name
+            if target.exists():
+                target = root / f"{job['id'][:8]}-{staged.name}"
+            shutil.move(staged, target)
+            shutil.rmtree(staged.parent, ignore_errors=True)
+            CATALOG.update(added=[target])
+            entry = entry_of(target, job["type"], INGEST_VERSION)
+            pending[entry.source] = (job["id"], entry)
+            JOBS.update(job["id"], source=entry.source)
+
+        def on_progress(state: FileState) -> None:
+            JOBS.update(
+                pending[state.source][0],
+                frames=state.frames,
+                frames_captioned=state.captioned,
+                docs_indexed=state.docs,
+            )
+
+        ingested: set[str] = set()
+        try:
+            ingested = {source_of(path) for path in make_pipeline(on_progress).run(
+                [(path_of(source), entry.type, entry.sha256) for source, (_, entry) in pending.items()],
+            )}
+            GlobalVariables.indexer.finish_bulk_load()
+            MANIFEST.upsert(entry for source, (_, entry) in pending.items() if source in ingested)
+        finally:
+            failed = [path_of(source) for source in pending.keys() - ingested]
+            for path in failed:
+                path.unlink(missing_ok=True)
+            CATALOG.update(removed=failed)
+        for source, (job_id, _) in pending.items():
+            if source in ingested:
+                job = JOBS.get(job_id)
+                JOBS.update(job_id, status="done", docs_committed=job["docs_indexed"] if job else 0)
+            else:
+                JOBS.update(job_id, status="failed", error="the file could not be decoded or captioned")
+
+
+@contextmanager
+def startup_phase(name: str) -> Iterator[None]:
+    """Log how long a phase of the startup took, so cold-start regressions show up in the logs."""
+    start = time.perf_counter()
+    yield
+    logger.info(f"Startup phase '{name}' took {time.perf_counter() - start:.2f}s")
 
 
 def startup() -> dict:
-    """Reload the images and videos on startup."""
+    """Open the index and bring it up to date with the images and videos on disk."""
     try:
-        initialize_index()
-        writer = None
-        writer = GlobalVariables.index.writer()
-        writer.delete_all_documents()
-        writer.commit()
-        writer = None
-        batch_size = 16
-        logger.info("Starting to process images")
-        image_adder(add_fn=add_multiple, batch_size=batch_size, model=MODEL)
-        logger.info("Starting to process videos")
-        video_adder(add_fn=add_multiple, batch_size=batch_size, model=MODEL)
-        logger.info("Data loading completed successfully")
+        with startup_phase("open index"):
+            initialize_index()
+        return initial_sync()
     except (Exception, BaseExceptionGroup) as e:
         logger.error(f"Error during startup: {e!s}")
         return {"response": str(e)}
-    else:
-        return {"response": "okay"}
 
 
-def set_index() -> None:
-    """Reset index."""
-    GlobalVariables.index = tantivy.Index.open(INDEX_PATH.as_posix())
+def initial_sync() -> dict:
+    """Wait for the model service, mark this run of the searcher ready and sync the index with the disk.
+
+    Queries only need the opened index, so the searcher is ready as soon as the model service is,
+    and the progress of the sync is reported by `/sync` instead.
+    """
+    try:
+        with startup_phase("wait for the model service"):
+            model_ready = MODEL.wait_until_ready(CONFIG["startup"]["model_ready_timeout"])
+        if model_ready:
+            MANIFEST.set_meta("ready_run", RUN_ID)
+        else:
+            logger.warning("The model service is not ready, syncing anyway")
+        with startup_phase("sync index"):
+            sync_index()
+        MANIFEST.set_meta("ready_run", RUN_ID)
+        MANIFEST.set_meta("synced_run", RUN_ID)
+    except (Exception, BaseExceptionGroup) as e:
+        logger.error(f"Error during startup: {e!s}")
+        return {"response": str(e)}
+    else:
+        return {"response": "okay"}
 
 
 def add_multiple(docs: Docs) -> None:
-    """Add multiple documents into tantivy index."""
-    writer = None
-    set_index()
-    writer = GlobalVariables.index.writer()
-    for doc, filename, typ, tstamp in zip(
-        docs.texts,
-        docs.filenames,
-        docs.types,
-        docs.timestamps,
-        strict=False,
-    ):
-        writer.add_document(
-            tantivy.Document(caption=doc, filename=filename, type=typ, timestamp=tstamp),
-        )
-    writer.commit()
-    writer = None
+    """Add multiple documents into tantivy index, they are searchable after the next commit."""
+    GlobalVariables.indexer.add(docs)
+
+
+async def list_media(
+    typ: str,
+    request: fastapi.Request,
+    prefix: str,
+    cursor: str,
+    limit: int | None,
+) -> fastapi.Response:
+    """Serve a page of the media catalog, or 304 when the client already has it."""
+    if limit is not None:
+        limit = min(max(limit, 1), CONFIG["catalog"]["max_page_size"])
+    names, next_cursor = await asyncio.to_thread(CATALOG.page, typ, prefix, cursor, limit)
+    etag = CATALOG.etag(names, next_cursor)
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if etag in request.headers.get("if-none-match", "").replace(" ", "").split(","):
+        return fastapi.Response(status_code=304, headers=headers)
+    return JSONResponse({"response": names, "next_cursor": next_cursor}, headers=headers)
 
 
 @app.get("/all_images")
-async def all_images() -> dict:
-    """Get the filenames of all the images."""
-    image_names = []
-    for _dirpath, _dirnames, filenames in os.walk(IMAGES_PATH):
-        image_names.extend(filenames)
-    return {"response": image_names}
+async def all_images(
+    request: fastapi.Request,
+    prefix: str = "",
+    cursor: str = "",
+    limit: int | None = None,
+) -> fastapi.Response:
+    """Get a page of the image filenames, pass the returned `next_cursor` as `cursor` for the next one."""
+    return await list_media("image", request, prefix, cursor, limit)
 
 
 @app.get("/all_videos")
-async def all_videos() -> dict:
-    """Get the filenames of all the videos."""
-    image_names = []
-    for _dirpath, _dirnames, filenames in os.walk(VIDEOS_PATH):
-        image_names.extend(filenames)
-    return {"response": image_names}
+async def all_videos(
+    request: fastapi.Request,
+    prefix: str = "",
+    cursor: str = "",
+    limit: int | None = None,
+) -> fastapi.Response:
+    """Get a page of the video filenames, pass the returned `next_cursor` as `cursor` for the next one."""
+    return await list_media("video", request, prefix, cursor, limit)
+
+
+def bm25_search(query: Query, limit: int, searcher: tantivy.Searcher | None = None) -> list[dict]:
+    """Rank the captions of the requested type against the query text with BM25."""
+    searcher = searcher or GlobalVariables.index.searcher()
+    caption_query = GlobalVariables.index.parse_query(query.text, ["caption"])
+    type_query = tantivy.Query.term_query(
+        schema=GlobalVariables.index.schema,
+        field_name="type",
+        field_value=query.type,
+    )
+    parsed_query = tantivy.Query.boolean_query(
+        [
+            (tantivy.Occur.Must, caption_query),
+            (tantivy.Occur.Must, type_query),
+        ],
+    )
+    return materialize_hits(searcher, searcher.search(parsed_query, limit=limit).hits)
+
+
+def search_query(query: Query, searcher: tantivy.Searcher, embedding: np.ndarray | None) -> list[dict]:
+    """Rank one query in its mode, `embedding` being the one of its text for the dense and hybrid modes.
+
+    Nothing here touches the event loop, so queries can run in worker threads.
+    """
+    if query.mode == "bm25":
+        results = bm25_search(query, query.n, searcher)
+    elif query.mode == "dense":
+        results = VECTORS.search(embedding, query.n, query.type)
+    else:
+        candidates = max(query.n, EMBEDDINGS["fusion_candidates"])
+        results = reciprocal_rank_fusion(
+            [bm25_search(query, candidates, searcher), VECTORS.search(embedding, candidates, query.type)],
+            n=query.n,
+            k=EMBEDDINGS["rrf_k"],
+        )
+    return [result | preview_urls(result) for result in results]
+
+
+def index_generation() -> str:
+    """Identify the state of everything a query reads, cached results are only reused while it holds."""
+    return "-".join(map(str, GlobalVariables.index.generation)) + f"-{VECTORS.generation()}"
 
 
-@lru_cache
 @app.post("/query")
 async def query(query: Query) -> dict:
     """Make a query."""
     try:
         logger.info(
-            f"Processing query: '{query.text}', type: {query.type}, limit: {query.n}",
+            f"Processing query: '{query.text}', type: {query.type}, limit: {query.n}, mode: {query.mode}",
         )
-        set_index()
-        searcher = None
-        searcher = GlobalVariables.index.searcher()
+        if query.mode != "bm25" and not EMBEDDINGS["enabled"]:
+            return {"response": "dense retrieval is disabled, set embeddings.enabled in config.yaml", "results": []}
+        key = cache_key(query.text, query.type, query.n, query.mode)
+        generation = index_generation()
+        results = await QUERY_CACHE.get(key, generation)
+        if results is not None:
+            logger.info(f"Query served from cache with {len(results)} results")
+            return {"response": "okay", "results": results}
+        embedding = (await MODEL.aembed_texts([query.text]))[0] if query.mode != "bm25" else None
         try:
-            caption_query = GlobalVariables.index.parse_query(query.text, ["caption"])
-            type_query = tantivy.Query.term_query(
-                schema=GlobalVariables.index.schema,
-                field_name="type",
-                field_value=query.type,
-            )
-            parsed_query = tantivy.Query.boolean_query(
-                [
-                    (tantivy.Occur.Must, caption_query),
-                    (tantivy.Occur.Must, type_query),
-                ],
+            results = await asyncio.get_running_loop().run_in_executor(
+                QUERY_POOL,
+                search_query,
+                query,
+                GlobalVariables.index.searcher(),
+                embedding,
             )
         except ValueError as e:
             return {"response": str(e), "results": []}
-        results = [
-            {
-                "filename": searcher.doc(doc)["filename"][0],
-                "caption": searcher.doc(doc)["caption"][0],
-                "type": searcher.doc(doc)["type"][0],
-                "timestamp": searcher.doc(doc)["timestamp"][0],
-            }
-            for _, doc in searcher.search(parsed_query, limit=query.n).hits
-        ]
-        unique = {
-            (result["filename"], result["caption"], result["type"], result["timestamp"]) for result in results
-        }
-        results = [
-            {
-                "filename":result[0],
-                "caption":result[1],
-                "type":result[2],
-                "timestamp":result[3],
-            }
-            for result in unique
-        ]
-        searcher = None
+        await QUERY_CACHE.put(key, generation, results)
         logger.info(f"Query returned {len(results)} results")
 
     except (Exception, BaseException) as e:
         logger.exception(f"Query execution error: {e!s}")
-        return {"response": str(e), "results": {}}
+        return {"response": str(e), "results": []}
     else:
         return {"response": "okay", "results": results}
 
+
+@app.post("/query/batch")
+async def query_batch(queries: list[Query]) -> fastapi.Response:
+    """Make several queries at once, against the same index snapshot.
+
+    Queries missing from the cache run concurrently on the query thread pool, the texts of the
+    dense and hybrid ones being embedded in a single call, and every answer is shaped like the
+    response of `/query`, a query that fails only failing its own answer.
+    """
+    if len(queries) > CONFIG["batch_query"]["max_queries"]:
+        raise fastapi.HTTPException(status_code=413, detail="too many queries")
+    try:
+        logger.info(f"Processing a batch of {len(queries)} queries")
+        # The generation is read first, so results are at worst cached under an older generation than theirs.
+        generation = index_generation()
+        searcher = GlobalVariables.index.searcher()
+        keys = [cache_key(query.text, query.type, query.n, query.mode) for query in queries]
+        answers: list[dict | None] = []
+        for query, key in zip(queries, keys, strict=True):
+            results = await QUERY_CACHE.get(key, generation)
+            if results is not None:
+                answers.append({"response": "okay", "results": results})
+            elif query.mode != "bm25" and not EMBEDDINGS["enabled"]:
+                message = "dense retrieval is disabled, set embeddings.enabled in config.yaml"
+                answers.append({"response": message, "results": []})
+            else:
+                answers.append(None)
+        pending = [i for i, answer in enumerate(answers) if answer is None]
+        texts = list(dict.fromkeys(queries[i].text for i in pending if queries[i].mode != "bm25"))
+        embeddings = dict(zip(texts, await MODEL.aembed_texts(texts), strict=True)) if texts else {}
+        loop = asyncio.get_running_loop()
+        outcomes = await asyncio.gather(
+            *(
+                loop.run_in_executor(QUERY_POOL, search_query, queries[i], searcher, embeddings.get(queries[i].text))
+                for i in pending
+            ),
+            return_exceptions=True,
+        )
+        for i, outcome in zip(pending, outcomes, strict=True):
+            if isinstance(outcome, BaseException):
+                if not isinstance(outcome, ValueError):
+                    logger.opt(exception=outcome).error(f"Query execution error: {outcome!s}")
+                answers[i] = {"response": str(outcome), "results": []}
+            else:
+                await QUERY_CACHE.put(keys[i], generation, outcome)
+                answers[i] = {"response": "okay", "results": outcome}
+        logger.info(f"Query batch answered {len(pending)} queries, {len(queries) - len(pending)} from cache")
+    except (Exception, BaseException) as e:
+        logger.exception(f"Query batch execution error: {e!s}")
+        response = {"response": str(e), "results": []}
+    else:
+        response = {"response": "okay", "results": answers}
+    return fastapi.Response(orjson.dumps(response), media_type="application/json")
+
+
+async def receive_upload(request: fastapi.Request, path: Path) -> int:
+    """Write the body of an upload to `path` chunk by chunk and return its size, rejecting it once too large."""
+    size = 0
+    with path.open("wb") as file:
+        async for chunk in request.stream():
+            size += len(chunk)
+            if size > CONFIG["jobs"]["max_upload_bytes"]:
+                raise fastapi.HTTPException(status_code=413, detail="upload too large")
+            await asyncio.to_thread(file.write, chunk)
+    return size
+
+
+@app.post("/ingest", status_code=202)
+async def ingest(
+    request: fastapi.Request,
+    filename: str,
+    typ: Literal["image", "video"] | None = fastapi.Query(default=None, alias="type"),
+) -> dict:
+    """Stream an uploaded image or video to disk and queue a job that captions and indexes it.
+
+    The file is the raw request body, so it is written chunk by chunk and never held in memory.
+    """
+    name = Path(filename).name
+    typ = typ or media_type(name, request.headers.get("content-type"))
+    if not name or name.startswith(".") or typ is None:
+        raise fastapi.HTTPException(status_code=400, detail="expected an image or video with a file name")
+    job_id = JobStore.new_id()
+    staged = UPLOADS_PATH / job_id / name
+    try:
+        staged.parent.mkdir(parents=True)
+        size = await receive_upload(request, staged)
+        JOBS.create(job_id, name, typ, staged)
+    except fastapi.HTTPException:
+        shutil.rmtree(staged.parent, ignore_errors=True)
+        raise
+    except (Exception, BaseException) as e:
+        shutil.rmtree(staged.parent, ignore_errors=True)
+        logger.exception(f"Error while receiving {name}: {e!s}")
+        return {"response": str(e)}
+    logger.info(f"Queued ingestion job {job_id} for {name} ({size} bytes)")
+    return {"response": "okay", "job_id": job_id}
+
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str) -> dict:
+    """Get the status and progress of an ingestion job."""
+    job = await asyncio.to_thread(JOBS.get, job_id)
+    if job is None:
+        raise fastapi.HTTPException(status_code=404, detail="job not found")
+    del job["staged_path"]
+    return {"response": "okay", "job": job}
+
+
+def preview_urls(result: dict) -> dict:
+    """Link a search result to its thumbnail (poster frame for videos) and, for videos, its preview clip."""
+    filename = urllib.parse.quote(result["filename"])
+    urls = {"thumbnail": f"/thumbnail/{result['type']}/{filename}?t={result['timestamp']}"}
+    if result["type"] == "video":
+        urls["preview"] = f"/preview/{filename}?t={result['timestamp']}"
+    return urls
+
+
+def indexed_timestamp(source: str, t: int) -> int:
+    """Snap `t` to the start of the indexed segment of a video it falls in, the first one before it."""
+    starts = GlobalVariables.index.timestamps(source)
+    if not starts:
+        raise fastapi.HTTPException(status_code=404, detail="file not indexed")
+    return starts[max(bisect.bisect_right(starts, t) - 1, 0)]
+
+
+async def serve_preview(
+    request: fastapi.Request,
+    typ: str,
+    filename: str,
+    t: int,
+    make: Callable[[str, Path, int], str],
+) -> fastapi.Response:
+    """Serve a derived asset of an indexed file at `t` seconds, creating it first when it is missing.
+
+    Videos only get assets at the start of their indexed segments, so any other `t` is snapped to
+    one and clients cannot make the service encode and store an asset per distinct value.
+    """
+    source = source_of((IMAGES_PATH if typ == "image" else VIDEOS_PATH) / Path(filename).name)
+    entry = await asyncio.to_thread(MANIFEST.get, source)
+    if entry is None:
+        raise fastapi.HTTPException(status_code=404, detail="file not indexed")
+    t = await asyncio.to_thread(indexed_timestamp, source, t) if typ == "video" else 0
+    try:
+        relative_path = await asyncio.to_thread(make, entry.sha256, path_of(source), t)
+    except (OSError, subprocess.CalledProcessError) as e:
+        logger.warning(f"Could not create the preview of {source}: {e!s}")
+        raise fastapi.HTTPException(status_code=404, detail="preview not available") from e
+    response = await STATIC_FILES["previews"].get_response(relative_path, request.scope)
+    response.headers["Cache-Control"] = "public, max-age=86400"
+    return response
+
+
+@app.get("/thumbnail/{typ}/{filename}")
+async def thumbnail(
+    request: fastapi.Request,
+    typ: Literal["image", "video"],
+    filename: str,
+    t: int = 0,
+) -> fastapi.Response:
+    """Get the thumbnail of an image, or the poster frame of the segment of a video at `t` seconds."""
+    return await serve_preview(
+        request,
+        typ,
+        filename,
+        t,
+        lambda digest, path, timestamp: PREVIEWS.ensure_thumbnail(digest, path, typ, timestamp),
+    )
+
+
+@app.get("/preview/{filename}")
+async def preview(request: fastapi.Request, filename: str, t: int = 0) -> fastapi.Response:
+    """Get the short preview clip of the segment of a video at `t` seconds."""
+    return await serve_preview(request, "video", filename, t, PREVIEWS.ensure_clip)
+
+
+@app.get("/health")
+async def health() -> dict:
+    """Report that the worker is up."""
+    return {"response": "okay"}
+
+
+@app.get("/ready")
+async def ready() -> fastapi.Response:
+    """Report whether the index is open and the model service reachable, with a 503 until they are."""
+    is_ready = await asyncio.to_thread(MANIFEST.get_meta, "ready_run") == RUN_ID
+    return JSONResponse(
+        {"response": "okay" if is_ready else "starting", "ready": is_ready},
+        status_code=200 if is_ready else 503,
+    )
+
+
+@app.get("/sync")
+async def sync_status() -> dict:
+    """Report whether the startup sync finished and the progress of the running sync, if any."""
+    synced = await asyncio.to_thread(MANIFEST.get_meta, "synced_run") == RUN_ID
+    progress = await asyncio.to_thread(MANIFEST.get_meta, "sync")
+    return {
+        "response": "okay",
+        "initial_sync_done": synced,
+        **(orjson.loads(progress) if progress else {"running": False, "files": 0, "captioned": 0}),
+    }
+
+
+@app.get("/metrics/query_cache")
+async def query_cache_metrics() -> dict:
+    """Get the hit-rate metrics of the query result cache of this worker."""
+    return {"response": "okay", "metrics": QUERY_CACHE.stats()}
+
+
+@app.get("/metrics/static_cache")
+async def static_cache_metrics() -> dict:
+    """Get the usage and hit-rate metrics of the media file caches of this worker."""
+    return {"response": "okay", "metrics": {name: files.stats() for name, files in STATIC_FILES.items()}}
+
+
+async def read_image(upload: UploadFile) -> tuple[Image.Image, np.ndarray]:
+    """Decode an uploaded image, along with the frame ingestion would have made of it."""
+    image = Image.open(io.BytesIO(await upload.read())).convert("RGB")
+    return image, np.asarray(image.resize((MODEL.input_size, MODEL.input_size), Image.Resampling.BICUBIC))
+
+
+async def caption_image(image: Image.Image, image_hash: str) -> list[str]:
+    """Caption an image, going through the caption cache."""
+    caption = list((await asyncio.to_thread(CAPTION_CACHE.get_many, [image_hash])).values())
+    if not caption:
+        caption = await MODEL.agenerate_captions([image])
+        await asyncio.to_thread(CAPTION_CACHE.put_many, {image_hash: caption[0]})
+    return caption
+
+
+@app.post("/search_by_image")
+async def search_by_image(
+    image: UploadFile = File(...),
+    n: int = 10,
+    typ: Literal["image", "video"] | None = fastapi.Query(default=None, alias="type"),
+    fallback: bool | None = None,  # noqa: FBT001
+) -> dict:
+    """Find the indexed frames that look like an image.
+
+    Frames are matched on their perceptual hash (near duplicates, crops aside) and, when embeddings
+    are enabled, on their embedding, the two rankings being fused. Without any match, the image is
+    captioned and the caption searched with BM25 instead, unless `fallback` is false.
+    """
+    try:
+        image, frame = await read_image(image)
+        image_hash = await asyncio.to_thread(perceptual_hash, frame)
+        rankings = [
+            await asyncio.to_thread(
+                VECTORS.search_hash,
+                image_hash,
+                n,
+                typ,
+                CONFIG["image_search"]["max_hash_distance"],
+            ),
+        ]
+        if EMBEDDINGS["enabled"]:
+            embedding = (await MODEL.aembed_images([Image.fromarray(frame)]))[0]
+            rankings.append(await asyncio.to_thread(VECTORS.search, embedding, n, typ))
+        results = reciprocal_rank_fusion(rankings, n=n, k=EMBEDDINGS["rrf_k"]) if len(rankings) > 1 else rankings[0]
+        matched_by = "signature"
+        if not results and (CONFIG["image_search"]["fallback"] if fallback is None else fallback):
+            caption = (await caption_image(image, image_hash))[0]
+            logger.info(f"No signature matches the image, searching its caption: '{caption}'")
+            results = [
+                hit
+                for search_type in ([typ] if typ else ["image", "video"])
+                for hit in bm25_search(Query(text=caption, type=search_type, n=n), n)
+            ]
+            results = sorted(results, key=lambda hit: hit["score"], reverse=True)[:n]
+            matched_by = "caption"
+        results = [result | preview_urls(result) for result in results]
+        logger.info(f"Image search returned {len(results)} results by {matched_by}")
+    except (Exception, BaseException) as e:
+        logger.exception(f"Image search error: {e!s}")
+        return {"response": str(e), "results": []}
+    else:
+        return {"response": "okay", "matched_by": matched_by, "results": results}
+
+
 @app.post("/caption")
 async def caption(image: UploadFile = File(...)) -> dict:
     """Get the caption of an image."""
     try:
-        image_bytes = await image.read()
-        image = Image.open(io.BytesIO(image_bytes))
-        caption = await asyncio.threads.to_thread(MODEL.generate_captions, [image])
+        image, frame = await read_image(image)
+        caption = await caption_image(image, perceptual_hash(frame))
         response = {"response": "okay", "caption": caption}
     except (Exception, BaseException) as e:
         logger.exception(f"Error during captioning: {e!s}")
@@ -248,5 +738,27 @@ if __name__ == "__main__":
     import uvicorn
 
     logger.info("Starting the searcher API")
-    startup()
+    # The index is opened (and rebuilt if needed) before any worker reads it, the sync runs while serving.
+    with startup_phase("open index"):
+        initialize_index()
+
+    requeued, failed = JOBS.recover_running()
+    if requeued or failed:
+        logger.warning(f"Requeued {requeued} and failed {failed} upload jobs interrupted by the last shutdown")
+    # Uploads are accepted while the initial sync runs, they are ingested as soon as it releases the sync lock.
+    JobRunner(JOBS, run_jobs=run_jobs, poll_interval=CONFIG["jobs"]["poll_interval"]).start()
+
+    def start_ingestion() -> None:
+        """Sync the index, then keep ingesting changed files."""
+        initial_sync()
+        if CONFIG["watcher"]["enabled"]:
+            MediaWatcher(
+                roots=[IMAGES_PATH, VIDEOS_PATH],
+                on_change=sync_index,
+                poll_interval=CONFIG["watcher"]["poll_interval"],
+                debounce=CONFIG["watcher"]["debounce"],
+                on_files=CATALOG.update,
+            ).start()
+
+    threading.Thread(target=start_ingestion, name="startup", daemon=True).start()
     uvicorn.run("__main__:app", **CONFIG["searcher"])
@@ -0,0 +1,85 @@
+"""Persistent cache of captions keyed by image content."""
+
+import sqlite3
+import threading
+import time
+from collections.abc import Iterable
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+HASH_SIZE = 16
+
+
+def perceptual_hash(frame: np.ndarray) -> str:
+    """Compute the 256-bit difference hash of an HWC uint8 frame as hex.
+
+    The frame is box-filtered down to 17x16 grayscale and every bit tells whether a pixel is
+    brighter than its left neighbour, so re-encoded or resized copies of an image hash alike.
+    """
+    gray = Image.fromarray(frame).convert("L").resize((HASH_SIZE + 1, HASH_SIZE), Image.Resampling.BOX)
+    pixels = np.asarray(gray, dtype=np.int16)
+    return np.packbits(pixels[:, 1:] > pixels[:, :-1]).tobytes().hex()
+
+
+class CaptionCache:
+    """SQLite backed caption cache with least-recently-used eviction.
+
+    Keys combine the perceptual hash with `model_key`, which names the model and the generation
+    settings, so changing either never returns a stale caption.
+    """
+
+    def __init__(self, path: Path, model_key: str, max_entries: int = 1_000_000) -> None:
+        """Open (or create) the cache database."""
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.model_key = model_key
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path.as_posix(), check_same_thread=False, timeout=5)
+        with self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS captions ("
+                "key TEXT PRIMARY KEY, caption TEXT NOT NULL, last_used REAL NOT NULL)",
+            )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS captions_last_used ON captions (last_used)")
+
+    def key(self, image_hash: str) -> str:
+        """Scope an image hash to the model."""
+        return f"{self.model_key}:{image_hash}"
+
+    def get_many(self, hashes: Iterable[str]) -> dict[str, str]:
+        """Return the cached captions of the given hashes, marking them as recently used."""
+        keys = {self.key(image_hash): image_hash for image_hash in set(hashes)}
+        if not keys:
+            return {}
+        placeholders = ",".join("?" * len(keys))
+        with self.lock, self.connection:
+            rows = self.connection.execute(
+                f"SELECT key, caption FROM captions WHERE key IN ({placeholders})",  # noqa: S608
+                list(keys),
+            ).fetchall()
+            if rows:
+                self.connection.execute(
+                    f"UPDATE captions SET last_used = ? WHERE key IN ({placeholders})",  # noqa: S608
+                    [time.time(), *keys],
+                )
+        return {keys[key]: caption for key, caption in rows}
+
+    def put_many(self, captions: dict[str, str]) -> None:
+        """Store captions by image hash and evict the least recently used entries beyond `max_entries`."""
+        if not captions:
+            return
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO captions (key, caption, last_used) VALUES (?, ?, ?)",
+                [(self.key(image_hash), caption, now) for image_hash, caption in captions.items()],
+            )
+            excess = self.connection.execute("SELECT COUNT(*) FROM captions").fetchone()[0] - self.max_entries
+            if excess > 0:
+                self.connection.execute(
+                    "DELETE FROM captions WHERE key IN (SELECT key FROM captions ORDER BY last_used LIMIT ?)",
+                    (excess,),
+                )
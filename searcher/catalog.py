@@ -0,0 +1,90 @@
+"""Paginated listings of the media files."""
+
+import bisect
+import hashlib
+import os
+import threading
+from collections.abc import Iterable
+from pathlib import Path
+
+from manifest import PREFIX_END
+
+
+class MediaCatalog:
+    """Cursor paginated, prefix filtered listings of the files in the media directories.
+
+    Listings come from the directories themselves, so files are listed before the first sync has
+    ingested them and whether or not they could be captioned. Each directory is walked once, when it
+    is first listed, and its sorted names are then kept current by `update` with the files that
+    appear and disappear. Updates replace the list instead of changing it, so a page is always cut
+    from one consistent listing. ETags are made of the page contents, so a client revalidating an
+    unchanged listing gets a 304 without the body.
+    """
+
+    def __init__(self, roots: dict[str, Path]) -> None:
+        """Store the directory of each media type."""
+        self.roots = roots
+        self.listings: dict[str, list[str]] = {}
+        self.lock = threading.Lock()
+
+    def names(self, typ: str) -> list[str]:
+        """Return the sorted paths, relative to their directory, of the files of `typ`."""
+        with self.lock:
+            if typ not in self.listings:
+                root = self.roots[typ]
+                self.listings[typ] = sorted(
+                    Path(dirpath, filename).relative_to(root).as_posix()
+                    for dirpath, _dirnames, filenames in os.walk(root)
+                    for filename in filenames
+                )
+            return self.listings[typ]
+
+    def update(self, added: Iterable[str | Path] = (), removed: Iterable[str | Path] = ()) -> None:
+        """Insert the `added` files into the listings and drop the `removed` ones, ignoring paths outside the roots."""
+        inserted, dropped = self._names_by_type(added), self._names_by_type(removed)
+        with self.lock:
+            for typ, listing in self.listings.items():
+                gone = {name for name in dropped.get(typ, ()) if self._contains(listing, name)}
+                new = sorted(name for name in inserted.get(typ, ()) if not self._contains(listing, name))
+                if not (gone or new):
+                    continue
+                names = [name for name in listing if name not in gone] if gone else listing.copy()
+                for name in new:
+                    bisect.insort(names, name)
+                self.listings[typ] = names
+
+    def _names_by_type(self, paths: Iterable[str | Path]) -> dict[str, set[str]]:
+        """Group paths by the media directory they are in, as names relative to it."""
+        names: dict[str, set[str]] = {}
+        for path in paths:
+            for typ, root in self.roots.items():
+                name = Path(os.path.relpath(path, root))
+                if name.parts[0] != os.pardir:
+                    names.setdefault(typ, set()).add(name.as_posix())
+        return names
+
+    @staticmethod
+    def _contains(names: list[str], name: str) -> bool:
+        """Tell whether the sorted `names` contain `name`."""
+        at = bisect.bisect_left(names, name)
+        return at < len(names) and names[at] == name
+
+    def page(
+        self,
+        typ: str,
+        prefix: str = "",
+        cursor: str = "",
+        limit: int | None = None,
+    ) -> tuple[list[str], str | None]:
+        """List up to `limit` (all if None) names of `typ` with `prefix` after `cursor`, plus the next cursor."""
+        names = self.names(typ)
+        start = max(bisect.bisect_left(names, prefix), bisect.bisect_right(names, cursor) if cursor else 0)
+        end = bisect.bisect_left(names, prefix + PREFIX_END, lo=start)
+        page = names[start : end if limit is None else min(end, start + limit)]
+        return page, page[-1] if page and start + len(page) < end else None
+
+    @staticmethod
+    def etag(names: list[str], next_cursor: str | None) -> str:
+        """Tag a page by its contents, the tag changes whenever the listed files change."""
+        digest = hashlib.sha1("\0".join([*names, next_cursor or ""]).encode())  # noqa: S324
+        return f'W/"{digest.hexdigest()}"'
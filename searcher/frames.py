@@ -0,0 +1,100 @@
+"""Decoding and selection of the video frames worth captioning."""
+
+import logging
+from collections.abc import Iterable, Iterator
+from pathlib import Path
+
+import imageio_ffmpeg
+import numpy as np
+
+SIGNATURE_SIZE = 16
+HISTOGRAM_BINS = 32
+
+# imageio-ffmpeg warns whenever the output is scaled, which is exactly what stream_frames asks for.
+logging.getLogger("imageio_ffmpeg").setLevel(logging.ERROR)
+
+
+def stream_frames(
+    path: Path,
+    fps: float,
+    size: int,
+    meta: dict | None = None,
+) -> Iterator[tuple[float, np.ndarray]]:
+    """Decode a video once, front to back, yielding `fps` (timestamp, frame) pairs per second.
+
+    ffmpeg drops the frames in between and scales the kept ones to `size` x `size`, so nothing is
+    seeked and only frames already at the model input size reach Python. `meta`, when given, is
+    filled with the stream metadata reported by ffmpeg (such as `source_size` and `duration`).
+    """
+    reader = imageio_ffmpeg.read_frames(
+        path.as_posix(),
+        pix_fmt="rgb24",
+        output_params=["-vf", f"fps={fps},scale={size}:{size}:flags=bicubic"],
+    )
+    try:
+        header = next(reader)
+        if meta is not None:
+            meta.update(header)
+        width, height = header["size"]
+        for index, buffer in enumerate(reader):
+            yield index / fps, np.frombuffer(buffer, dtype=np.uint8).reshape(height, width, 3)
+    finally:
+        reader.close()
+
+
+class AdaptiveSampler:
+    """Keep only frames that differ enough from the last kept frame.
+
+    Every probed frame gets a cheap signature: a small grayscale thumbnail and a normalized
+    intensity histogram. A frame is kept when its novelty against the last kept frame, the mean of
+    the thumbnail difference and the histogram distance (both in [0, 1]), reaches `threshold`.
+    Kept frames are at least `min_interval` seconds apart, and a frame is always kept once
+    `max_interval` seconds passed without one so long static shots are still covered.
+    """
+
+    def __init__(
+        self,
+        probe_fps: float = 2,
+        threshold: float = 0.15,
+        min_interval: float = 1,
+        max_interval: float = 30,
+    ) -> None:
+        """Store the sampling bounds."""
+        self.probe_fps = probe_fps
+        self.threshold = threshold
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+
+    @staticmethod
+    def signature(frame: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """Compute the thumbnail and histogram of an HWC uint8 frame."""
+        gray = frame.mean(axis=2)
+        height, width = gray.shape
+        rows = np.linspace(0, height - 1, SIGNATURE_SIZE).astype(int)
+        cols = np.linspace(0, width - 1, SIGNATURE_SIZE).astype(int)
+        thumbnail = gray[np.ix_(rows, cols)] / 255
+        histogram = np.bincount((gray.ravel() * HISTOGRAM_BINS / 256).astype(int), minlength=HISTOGRAM_BINS)
+        return thumbnail, histogram / histogram.sum()
+
+    @staticmethod
+    def novelty(first: tuple[np.ndarray, np.ndarray], second: tuple[np.ndarray, np.ndarray]) -> float:
+        """Distance between two signatures in [0, 1]."""
+        thumbnail_distance = float(np.abs(first[0] - second[0]).mean())
+        histogram_distance = float(np.abs(first[1] - second[1]).sum()) / 2
+        return (thumbnail_distance + histogram_distance) / 2
+
+    def select(self, frames: Iterable[tuple[float, np.ndarray]]) -> Iterator[tuple[float, np.ndarray]]:
+        """Yield the (timestamp, frame) pairs of `frames` that should be captioned."""
+        last_time = None
+        last_signature = None
+        for t, frame in frames:
+            signature = self.signature(frame)
+            if last_time is not None:
+                elapsed = t - last_time
+                if elapsed < self.min_interval:
+                    continue
+                if elapsed < self.max_interval and self.novelty(signature, last_signature) < self.threshold:
+                    continue
+            last_time = t
+            last_signature = signature
+            yield t, frame
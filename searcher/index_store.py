@@ -0,0 +1,266 @@
+"""Tantivy index schema and lifecycle."""
+
+from __future__ import annotations
+
+import shutil
+import threading
+import time
+from typing import TYPE_CHECKING
+
+import tantivy
+from loguru import logger
+
+if TYPE_CHECKING:
+    from collections.abc import Callable, Iterable
+    from pathlib import Path
+
+    from request_models import Docs
+
+# Bump whenever the schema below changes, existing indexes are then rebuilt from scratch.
+SCHEMA_VERSION = "2"
+
+
+def build_schema() -> tantivy.Schema:
+    """Build the schema of the caption index."""
+    schema_builder = tantivy.SchemaBuilder()
+    schema_builder.add_text_field("caption", stored=True, tokenizer_name="en_stem")
+    schema_builder.add_text_field("filename", stored=True)
+    schema_builder.add_text_field("type", stored=True)
+    # A video document covers the segment [timestamp, end] made of `frames` captioned frames.
+    schema_builder.add_integer_field("timestamp", stored=True)
+    schema_builder.add_integer_field("end", stored=True)
+    schema_builder.add_integer_field("frames", stored=True)
+    # Untokenized path relative to the data directory, used to delete the documents of a file.
+    schema_builder.add_text_field("source", stored=True, tokenizer_name="raw")
+    return schema_builder.build()
+
+
+def open_index(path: Path, *, rebuild: bool = False) -> tantivy.Index:
+    """Open the index at `path`, creating it if missing or if `rebuild` is set."""
+    if rebuild and path.exists():
+        logger.info(f"Removing existing index at {path}")
+        shutil.rmtree(path)
+    if path.exists() and tantivy.Index.exists(path.as_posix()):
+        logger.info(f"Opening existing index at {path}")
+        return tantivy.Index.open(path.as_posix())
+    logger.info(f"Creating new index directory at {path}")
+    path.mkdir(parents=True, exist_ok=True)
+    return tantivy.Index(schema=build_schema(), path=path.as_posix())
+
+
+def materialize_hits(searcher: tantivy.Searcher, hits: list[tuple[float, tantivy.DocAddress]]) -> list[dict]:
+    """Turn search hits into results, fetching each stored document once.
+
+    Results keep the rank order and score of the hits, later hits on an already returned
+    (filename, timestamp) pair are dropped.
+    """
+    results = []
+    seen = set()
+    for score, address in hits:
+        doc = searcher.doc(address)
+        key = (doc["filename"][0], doc["timestamp"][0])
+        if key in seen:
+            continue
+        seen.add(key)
+        results.append(
+            {
+                "filename": key[0],
+                "caption": doc["caption"][0],
+                "type": doc["type"][0],
+                "timestamp": key[1],
+                "end": doc["end"][0],
+                "frames": doc["frames"][0],
+                "score": score,
+            },
+        )
+    return results
+
+
+class IndexStore:
+    """Process-wide index handle with a searcher that is only refreshed after a commit.
+
+    The commit generation is read from tantivy's `meta.json`, which is atomically replaced on every
+    commit, so workers that never write still notice commits made by the ingesting process.
+    """
+
+    def __init__(self, path: Path) -> None:
+        """Store the index location, the index itself is opened lazily."""
+        self.path = path
+        self.lock = threading.Lock()
+        self._index: tantivy.Index | None = None
+        self._searcher: tantivy.Searcher | None = None
+        self._generation: tuple[int, int, int] | None = None
+
+    def open(self, *, rebuild: bool = False) -> tantivy.Index:
+        """(Re)open the index, see `open_index`."""
+        with self.lock:
+            self._index = open_index(self.path, rebuild=rebuild)
+            self._index.config_reader(reload_policy="Manual")
+            self._searcher = None
+            return self._index
+
+    @property
+    def index(self) -> tantivy.Index:
+        """The underlying index, opened from disk on first use."""
+        if self._index is None:
+            with self.lock:
+                if self._index is None:
+                    self._index = tantivy.Index.open(self.path.as_posix())
+                    self._index.config_reader(reload_policy="Manual")
+        return self._index
+
+    @property
+    def schema(self) -> tantivy.Schema:
+        """Schema of the index."""
+        return self.index.schema
+
+    @property
+    def generation(self) -> tuple[int, int, int]:
+        """Identify the last commit from the inode, mtime and size of `meta.json`."""
+        try:
+            stat = (self.path / "meta.json").stat()
+        except FileNotFoundError:
+            return (0, 0, 0)
+        return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+    def invalidate(self) -> None:
+        """Drop the cached searcher, used right after a commit in this process."""
+        with self.lock:
+            self._searcher = None
+
+    def searcher(self) -> tantivy.Searcher:
+        """Return the shared searcher, reloading it only if a commit happened since it was built."""
+        index = self.index
+        generation = self.generation
+        with self.lock:
+            if self._searcher is None or generation != self._generation:
+                index.reload()
+                self._searcher = index.searcher()
+                self._generation = generation
+            return self._searcher
+
+    def timestamps(self, source: str, limit: int = 100_000) -> list[int]:
+        """Sorted start timestamps of the documents of a file, the segment starts for a video."""
+        searcher = self.searcher()
+        query = tantivy.Query.term_query(self.schema, "source", source)
+        return sorted({searcher.doc(address)["timestamp"][0] for _, address in searcher.search(query, limit).hits})
+
+    def parse_query(self, text: str, default_field_names: list[str]) -> tantivy.Query:
+        """Parse a query string against the index."""
+        return self.index.parse_query(text, default_field_names)
+
+    def writer(self, heap_size: int = 128_000_000, num_threads: int = 0) -> tantivy.IndexWriter:
+        """Create an index writer, prefer the process-wide `IndexingService`."""
+        return self.index.writer(heap_size, num_threads)
+
+
+class IndexingService:
+    """Owns the single writer of the index and batches commits.
+
+    Documents are committed once `commit_every_docs` of them are pending or `commit_every_seconds`
+    have passed since the last commit, instead of once per captioning batch, which keeps the number
+    of segments and fsyncs low during a bulk load.
+    """
+
+    def __init__(  # noqa: PLR0913
+        self,
+        store: IndexStore,
+        *,
+        heap_size: int = 128_000_000,
+        num_threads: int = 0,
+        commit_every_docs: int = 10_000,
+        commit_every_seconds: float = 30,
+        on_commit: Callable[[], None] | None = None,
+    ) -> None:
+        """Store the writer settings, the writer is created on first use."""
+        self.store = store
+        self.heap_size = heap_size
+        self.num_threads = num_threads
+        self.commit_every_docs = commit_every_docs
+        self.commit_every_seconds = commit_every_seconds
+        self.on_commit = on_commit
+        self.lock = threading.RLock()
+        self._writer: tantivy.IndexWriter | None = None
+        self.pending = 0
+        self.last_commit = time.monotonic()
+
+    @property
+    def writer(self) -> tantivy.IndexWriter:
+        """The long-lived writer, created on first use."""
+        if self._writer is None:
+            self._writer = self.store.writer(self.heap_size, self.num_threads)
+        return self._writer
+
+    def add(self, docs: Docs) -> None:
+        """Queue documents for the next commit."""
+        with self.lock:
+            for doc, filename, typ, tstamp, end, frames, source in zip(
+                docs.texts,
+                docs.filenames,
+                docs.types,
+                docs.timestamps,
+                docs.ends,
+                docs.frames,
+                docs.sources,
+                strict=False,
+            ):
+                self.writer.add_document(
+                    tantivy.Document(
+                        caption=doc,
+                        filename=filename,
+                        type=typ,
+                        timestamp=tstamp,
+                        end=end,
+                        frames=frames,
+                        source=source,
+                    ),
+                )
+                self.pending += 1
+            self.commit_if_due()
+
+    def delete_sources(self, sources: Iterable[str]) -> None:
+        """Queue the deletion of every document of the given files."""
+        with self.lock:
+            for source in sources:
+                self.writer.delete_documents("source", source)
+                self.pending += 1
+            self.commit_if_due()
+
+    def commit_if_due(self) -> bool:
+        """Commit if enough documents are pending or the last commit is old enough."""
+        with self.lock:
+            if self.pending == 0:
+                return False
+            due = (
+                self.pending >= self.commit_every_docs
+                or time.monotonic() - self.last_commit >= self.commit_every_seconds
+            )
+            if due:
+                self.commit()
+            return due
+
+    def commit(self) -> None:
+        """Commit pending changes and let searchers pick them up."""
+        with self.lock:
+            if self.pending == 0:
+                return
+            logger.info(f"Committing {self.pending} index operations")
+            self.writer.commit()
+            self.pending = 0
+            self.last_commit = time.monotonic()
+        self.store.invalidate()
+        if self.on_commit is not None:
+            self.on_commit()
+
+    def finish_bulk_load(self) -> None:
+        """Commit, release the writer and log the segment count.
+
+        Tantivy merges segments in the background according to its merge policy and has no call to
+        force a merge, so this only waits for the merges already scheduled by the commits to finish.
+        """
+        with self.lock:
+            self.commit()
+            if self._writer is not None:
+                self._writer.wait_merging_threads()
+                self._writer = None
+        logger.info(f"Bulk load finished with {self.store.searcher().num_segments} segments")
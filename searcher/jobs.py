@@ -0,0 +1,164 @@
+"""Tracking of upload-and-index jobs."""
+
+import mimetypes
+import shutil
+import sqlite3
+import threading
+import time
+import uuid
+from collections.abc import Callable
+from pathlib import Path
+
+from loguru import logger
+
+JOB_FIELDS = (
+    "id",
+    "filename",
+    "type",
+    "status",
+    "staged_path",
+    "source",
+    "frames",
+    "frames_captioned",
+    "docs_indexed",
+    "docs_committed",
+    "error",
+    "created",
+    "updated",
+)
+
+
+def media_type(filename: str, content_type: str | None = None) -> str | None:
+    """Tell whether an upload is an image or a video from its content type, falling back to its extension."""
+    for mime in (content_type, mimetypes.guess_type(filename)[0]):
+        kind = (mime or "").split("/")[0]
+        if kind in {"image", "video"}:
+            return kind
+    return None
+
+
+class JobStore:
+    """SQLite backed job table, shared by the uvicorn workers that accept uploads and the ingesting process."""
+
+    def __init__(self, path: Path) -> None:
+        """Open (or create) the job database."""
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path.as_posix(), check_same_thread=False, timeout=5)
+        with self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, filename TEXT NOT NULL, type TEXT NOT NULL, status TEXT NOT NULL, "
+                "staged_path TEXT NOT NULL, source TEXT, frames INTEGER NOT NULL DEFAULT 0, "
+                "frames_captioned INTEGER NOT NULL DEFAULT 0, docs_indexed INTEGER NOT NULL DEFAULT 0, "
+                "docs_committed INTEGER NOT NULL DEFAULT 0, error TEXT, created REAL NOT NULL, updated REAL NOT NULL)",
+            )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)")
+
+    def create(self, job_id: str, filename: str, typ: str, staged_path: Path) -> None:
+        """Queue a job for a file that has been fully written to `staged_path`."""
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT INTO jobs (id, filename, type, status, staged_path, created, updated) "
+                "VALUES (?, ?, ?, 'queued', ?, ?, ?)",
+                (job_id, filename, typ, staged_path.as_posix(), now, now),
+            )
+
+    def get(self, job_id: str) -> dict | None:
+        """Return a job as a dict."""
+        with self.lock:
+            row = self.connection.execute(
+                f"SELECT {', '.join(JOB_FIELDS)} FROM jobs WHERE id = ?",  # noqa: S608
+                (job_id,),
+            ).fetchone()
+        return dict(zip(JOB_FIELDS, row, strict=True)) if row else None
+
+    def claim_queued(self) -> list[dict]:
+        """Mark every queued job as running and return them."""
+        with self.lock, self.connection:
+            rows = self.connection.execute(
+                f"SELECT {', '.join(JOB_FIELDS)} FROM jobs WHERE status = 'queued' ORDER BY created",  # noqa: S608
+            ).fetchall()
+            self.connection.executemany(
+                "UPDATE jobs SET status = 'running', updated = ? WHERE id = ?",
+                [(time.time(), row[0]) for row in rows],
+            )
+        return [dict(zip(JOB_FIELDS, row, strict=True)) | {"status": "running"} for row in rows]
+
+    def recover_running(self) -> tuple[int, int]:
+        """Requeue the jobs a previous run left running, or fail those whose staged file is gone.
+
+        A job whose file was already moved into the media directories is picked up by the initial
+        sync, so only its staging directory is removed. Returns the requeued and failed counts.
+        """
+        with self.lock, self.connection:
+            rows = self.connection.execute("SELECT id, staged_path FROM jobs WHERE status = 'running'").fetchall()
+            requeued = [job_id for job_id, staged_path in rows if Path(staged_path).is_file()]
+            failed = [(job_id, staged_path) for job_id, staged_path in rows if job_id not in requeued]
+            now = time.time()
+            self.connection.executemany(
+                "UPDATE jobs SET status = 'queued', updated = ? WHERE id = ?",
+                [(now, job_id) for job_id in requeued],
+            )
+            self.connection.executemany(
+                "UPDATE jobs SET status = 'failed', error = ?, updated = ? WHERE id = ?",
+                [("interrupted by a restart, the next sync ingests the file", now, job_id) for job_id, _ in failed],
+            )
+        for _, staged_path in failed:
+            shutil.rmtree(Path(staged_path).parent, ignore_errors=True)
+        return len(requeued), len(failed)
+
+    def update(self, job_id: str, **fields: str | int | None) -> None:
+        """Update some fields of a job."""
+        columns = [column for column in fields if column in JOB_FIELDS]
+        with self.lock, self.connection:
+            self.connection.execute(
+                f"UPDATE jobs SET {', '.join(f'{column} = ?' for column in columns)}, updated = ? WHERE id = ?",  # noqa: S608
+                [*(fields[column] for column in columns), time.time(), job_id],
+            )
+
+    @staticmethod
+    def new_id() -> str:
+        """Generate a job id."""
+        return uuid.uuid4().hex
+
+
+class JobRunner:
+    """Background thread that hands queued jobs to `run_jobs` in batches.
+
+    All jobs queued since the last poll are run together so they share one ingestion pipeline and
+    its decode and captioning parallelism.
+    """
+
+    def __init__(self, store: JobStore, run_jobs: Callable[[list[dict]], None], poll_interval: float = 1) -> None:
+        """Store the job table and the function that ingests a batch of jobs."""
+        self.store = store
+        self.run_jobs = run_jobs
+        self.poll_interval = poll_interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="job-runner", daemon=True)
+
+    def start(self) -> None:
+        """Start running jobs in a background thread."""
+        self.thread.start()
+
+    def stop(self) -> None:
+        """Stop running jobs."""
+        self.stopped.set()
+        self.thread.join()
+
+    def _run(self) -> None:
+        """Poll the job table until stopped."""
+        while not self.stopped.wait(self.poll_interval):
+            jobs = self.store.claim_queued()
+            if not jobs:
+                continue
+            logger.info(f"Running {len(jobs)} ingestion jobs")
+            try:
+                self.run_jobs(jobs)
+            except Exception as e:  # noqa: BLE001
+                logger.exception(f"Ingestion jobs failed: {e!s}")
+                for job in jobs:
+                    self.store.update(job["id"], status="failed", error=str(e))
@@ -0,0 +1,229 @@
+"""Manifest of ingested media files."""
+
+import hashlib
+import os
+import sqlite3
+import threading
+from collections.abc import Iterable
+from pathlib import Path
+
+from pydantic import BaseModel, Field
+
+DATA_PATH = Path("..", "data")
+HASH_CHUNK_SIZE = 1 << 20
+# Sorts after every other character, so [prefix, prefix + PREFIX_END) holds every string starting with prefix.
+PREFIX_END = chr(0x10FFFF)
+
+
+class ManifestEntry(BaseModel):
+    """A single ingested file."""
+
+    source: str
+    type: str
+    size: int
+    mtime_ns: int
+    sha256: str
+    model_version: str
+
+
+class ManifestDiff(BaseModel):
+    """Files that need to be (re)ingested or removed from the index."""
+
+    new: list[ManifestEntry] = Field(default=[])
+    changed: list[ManifestEntry] = Field(default=[])
+    deleted: list[str] = Field(default=[])
+    touched: list[ManifestEntry] = Field(default=[])
+
+    @property
+    def to_ingest(self) -> list[ManifestEntry]:
+        """Entries whose captions have to be generated."""
+        return self.new + self.changed
+
+    @property
+    def to_delete(self) -> list[str]:
+        """Sources whose documents have to be removed from the index.
+
+        New files are included so that a run interrupted between commit and manifest update
+        does not leave duplicate documents behind.
+        """
+        return [entry.source for entry in self.to_ingest] + self.deleted
+
+
+def source_of(path: Path) -> str:
+    """Key a media file by its path relative to the data directory."""
+    return Path(os.path.relpath(path, DATA_PATH)).as_posix()
+
+
+def path_of(source: str) -> Path:
+    """Resolve a manifest key back to a path on disk."""
+    return DATA_PATH / source
+
+
+def file_sha256(path: Path) -> str:
+    """Hash the file contents in chunks."""
+    digest = hashlib.sha256()
+    with path.open("rb") as file:
+        while chunk := file.read(HASH_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def entry_of(path: Path, typ: str, model_version: str) -> ManifestEntry:
+    """Describe a media file on disk as a manifest entry."""
+    stat = path.stat()
+    return ManifestEntry(
+        source=source_of(path),
+        type=typ,
+        size=stat.st_size,
+        mtime_ns=stat.st_mtime_ns,
+        sha256=file_sha256(path),
+        model_version=model_version,
+    )
+
+
+class Manifest:
+    """SQLite backed record of every file that has been captioned into the index."""
+
+    def __init__(self, path: Path) -> None:
+        """Open (or create) the manifest database."""
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path.as_posix(), check_same_thread=False)
+        with self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS files ("
+                "source TEXT PRIMARY KEY, type TEXT NOT NULL, size INTEGER NOT NULL, "
+                "mtime_ns INTEGER NOT NULL, sha256 TEXT NOT NULL, model_version TEXT NOT NULL)",
+            )
+            self.connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+    def get_meta(self, key: str) -> str | None:
+        """Read a metadata value."""
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key: str, value: str) -> None:
+        """Write a metadata value."""
+        with self.lock, self.connection:
+            self.connection.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def entries(self) -> dict[str, ManifestEntry]:
+        """Load every entry keyed by source."""
+        with self.lock:
+            rows = self.connection.execute(
+                "SELECT source, type, size, mtime_ns, sha256, model_version FROM files",
+            ).fetchall()
+        return {
+            row[0]: ManifestEntry(
+                source=row[0],
+                type=row[1],
+                size=row[2],
+                mtime_ns=row[3],
+                sha256=row[4],
+                model_version=row[5],
+            )
+            for row in rows
+        }
+
+    def version(self) -> int:
+        """Counter bumped by every change to the set of files, used to tag listings."""
+        return int(self.get_meta("version") or 0)
+
+    def _bump_version(self) -> None:
+        """Bump the version counter inside the current transaction."""
+        self.connection.execute(
+            "INSERT INTO meta (key, value) VALUES ('version', '1') "
+            "ON CONFLICT (key) DO UPDATE SET value = CAST(value AS INTEGER) + 1",
+        )
+
+    def get(self, source: str) -> ManifestEntry | None:
+        """Load the entry of a single source."""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT source, type, size, mtime_ns, sha256, model_version FROM files WHERE source = ?",
+                (source,),
+            ).fetchone()
+        if row is None:
+            return None
+        return ManifestEntry(
+            source=row[0],
+            type=row[1],
+            size=row[2],
+            mtime_ns=row[3],
+            sha256=row[4],
+            model_version=row[5],
+        )
+
+    def upsert(self, entries: Iterable[ManifestEntry]) -> None:
+        """Insert or update entries."""
+        rows = [
+            (entry.source, entry.type, entry.size, entry.mtime_ns, entry.sha256, entry.model_version)
+            for entry in entries
+        ]
+        if not rows:
+            return
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO files (source, type, size, mtime_ns, sha256, model_version) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                rows,
+            )
+            self._bump_version()
+
+    def remove(self, sources: Iterable[str]) -> None:
+        """Forget the given sources."""
+        rows = [(source,) for source in sources]
+        if not rows:
+            return
+        with self.lock, self.connection:
+            self.connection.executemany("DELETE FROM files WHERE source = ?", rows)
+            self._bump_version()
+
+    def clear(self) -> None:
+        """Forget every file."""
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM files")
+            self._bump_version()
+
+    def diff(self, roots: dict[str, Path], model_version: str) -> ManifestDiff:
+        """Compare the files under `roots` (type -> directory) against the manifest.
+
+        Files whose size and mtime are unchanged are skipped without being read. Files whose
+        stat changed but whose contents hash to the same value are only `touched`.
+        """
+        known = self.entries()
+        seen = set()
+        diff = ManifestDiff()
+        for typ, root in roots.items():
+            for dirpath, _dirnames, filenames in os.walk(root):
+                for filename in filenames:
+                    path = Path(dirpath, filename)
+                    source = source_of(path)
+                    seen.add(source)
+                    try:
+                        stat = path.stat()
+                    except OSError:
+                        continue
+                    previous = known.get(source)
+                    if (
+                        previous is not None
+                        and previous.size == stat.st_size
+                        and previous.mtime_ns == stat.st_mtime_ns
+                        and previous.model_version == model_version
+                    ):
+                        continue
+                    try:
+                        entry = entry_of(path, typ, model_version)
+                    except OSError:
+                        continue
+                    if previous is None:
+                        diff.new.append(entry)
+                    elif previous.sha256 == entry.sha256 and previous.model_version == model_version:
+                        diff.touched.append(entry)
+                    else:
+                        diff.changed.append(entry)
+        diff.deleted = [source for source in known if source not in seen]
+        return diff
@@ -0,0 +1,539 @@
+"""Pipelined ingestion of images and videos.
+
+Files flow through four stages connected by bounded queues, so that a slow stage applies
+backpressure to the ones before it instead of buffering the whole corpus. Decode workers send the
+frames of a file in chunks of one captioning batch, so a long video is never held in memory whole:
+
+file discovery -> decode / frame extraction (process pool) -> captioning (concurrent batches)
+-> index writer (single committer)
+"""
+
+import asyncio
+import math
+import multiprocessing
+import multiprocessing.queues
+import queue
+import threading
+import time
+from collections import deque
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import Future, ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from caption_cache import CaptionCache, perceptual_hash
+from frames import AdaptiveSampler, stream_frames
+from loguru import logger
+from manifest import source_of
+from PIL import Image
+from previews import PreviewStore
+from request_models import Docs
+from segments import merge_frames
+from utils import Blip
+from vector_store import VectorStore
+
+_DONE = object()
+# Set in every decode worker by `_init_decoder`, the queue the decoded chunks of frames are put on.
+_chunks: multiprocessing.queues.Queue | None = None
+
+
+def _init_decoder(chunks: multiprocessing.queues.Queue) -> None:
+    """Hand a decode worker the queue it sends frames back on."""
+    global _chunks  # noqa: PLW0603
+    _chunks = chunks
+
+
+def decode_image(
+    path: Path,
+    digest: str,
+    size: int,
+    previews: PreviewStore | None = None,
+) -> list[tuple[int, np.ndarray]]:
+    """Decode an image into a single frame at the model input size, storing its thumbnail on the way.
+
+    `digest` is the content hash of the file the previews are stored under.
+    """
+    with Image.open(path) as file:
+        image = file.convert("RGB")
+    if previews is not None:
+        try:
+            previews.save_thumbnail(digest, image)
+        except Exception as e:  # noqa: BLE001
+            logger.warning(f"Could not store the thumbnail of {path}: {e!s}")
+    return [(0, np.asarray(image.resize((size, size), Image.Resampling.BICUBIC)))]
+
+
+def decode_video(  # noqa: PLR0913
+    path: Path,
+    digest: str,
+    size: int,
+    sampler: AdaptiveSampler,
+    *,
+    chunk_size: int,
+    previews: PreviewStore | None = None,
+    meta: dict | None = None,
+) -> Iterator[list[tuple[int, np.ndarray]]]:
+    """Stream the video once at the model input size and yield the frames selected by `sampler` in chunks.
+
+    `meta` is filled with the stream metadata, such as the `duration` of the video in seconds. The
+    kept frames double as the poster frames of the video, and the preview clips starting at them are
+    encoded too when the store is set up to do so during ingestion.
+    """
+    meta = {} if meta is None else meta
+    chunk: list[tuple[int, np.ndarray]] = []
+    for t, frame in sampler.select(stream_frames(path, sampler.probe_fps, size, meta=meta)):
+        chunk.append((int(t), frame))
+        if len(chunk) >= chunk_size:
+            save_video_previews(path, digest, chunk, meta, previews)
+            yield chunk
+            chunk = []
+    if chunk:
+        save_video_previews(path, digest, chunk, meta, previews)
+        yield chunk
+
+
+def save_video_previews(
+    path: Path,
+    digest: str,
+    frames: list[tuple[int, np.ndarray]],
+    meta: dict,
+    previews: PreviewStore | None,
+) -> None:
+    """Store the poster frames (and clips) of some kept frames of a video, logging failures."""
+    if previews is None:
+        return
+    try:
+        previews.save_posters(digest, frames, meta["source_size"])
+        if previews.clips_at_ingestion:
+            previews.save_clips(digest, path, [timestamp for timestamp, _ in frames])
+    except Exception as e:  # noqa: BLE001
+        logger.warning(f"Could not store the previews of {path}: {e!s}")
+
+
+def decode_file(  # noqa: PLR0913
+    index: int,
+    path: Path,
+    typ: str,
+    digest: str,
+    size: int,
+    *,
+    sampler: AdaptiveSampler,
+    chunk_size: int,
+    previews: PreviewStore | None = None,
+) -> None:
+    """Decode a media file into chunks of (timestamp, pixels) frames, runs in a worker process.
+
+    Chunks are put on the decoder queue as `("frames", index, chunk)` messages, which blocks while the
+    captioning stage is behind, followed by `("done", index, duration)` or `("failed", index, error)`.
+    """
+    try:
+        if typ == "video":
+            meta: dict = {}
+            for chunk in decode_video(path, digest, size, sampler, chunk_size=chunk_size, previews=previews, meta=meta):
+                _chunks.put(("frames", index, chunk))
+            duration = math.ceil(meta.get("duration") or 0)
+        else:
+            _chunks.put(("frames", index, decode_image(path, digest, size, previews)))
+            duration = 0
+    except Exception as e:  # noqa: BLE001
+        _chunks.put(("failed", index, str(e)))
+    else:
+        _chunks.put(("done", index, duration))
+
+
+class StageStats:
+    """Throughput counters of one pipeline stage."""
+
+    def __init__(self, name: str) -> None:
+        """Start the stage clock."""
+        self.name = name
+        self.files = 0
+        self.frames = 0
+        self.cached = 0
+        self.started = time.monotonic()
+        self.finished: float | None = None
+
+    def finish(self) -> None:
+        """Stop the stage clock."""
+        self.finished = time.monotonic()
+
+    def report(self) -> str:
+        """Describe the throughput of the stage."""
+        elapsed = max((self.finished or time.monotonic()) - self.started, 1e-9)
+        report = (
+            f"{self.name}: {self.files} files, {self.frames} frames in {elapsed:.1f}s "
+            f"({self.files / elapsed:.2f} files/sec, {self.frames / elapsed:.2f} frames/sec)"
+        )
+        if self.cached:
+            report += f", {self.cached} frames served from the caption cache"
+        return report
+
+
+class FileState:
+    """Progress of one file through the pipeline."""
+
+    def __init__(self, path: Path, typ: str) -> None:
+        """Track a file whose frames are being decoded.
+
+        `frames` counts the frames decoded so far, it is final once `decoded` is set.
+        """
+        self.path = path
+        self.type = typ
+        self.source = source_of(path)
+        self.frames = 0
+        self.decoded = False
+        self.duration = 0
+        self.captioned = 0
+        self.indexed = 0
+        self.docs = 0
+        self.failed = False
+        self.finished = False
+        # Captioned (timestamp, caption, embedding, hash) frames of a video, merged into segments once all are in.
+        self.pending: list[tuple[int, str, np.ndarray | None, str | None]] = []
+
+
+class IngestionPipeline:
+    """Caption media files and add them to the index with every stage running concurrently."""
+
+    def __init__(  # noqa: PLR0913
+        self,
+        *,
+        add_fn: Callable[[Docs], None],
+        model: Blip,
+        sampler: AdaptiveSampler,
+        segment_similarity: float = 1.0,
+        caption_cache: CaptionCache | None = None,
+        previews: PreviewStore | None = None,
+        vectors: VectorStore | None = None,
+        batch_size: int = 16,
+        decode_workers: int = 4,
+        caption_concurrency: int = 4,
+        queue_frames: int = 1024,
+        on_progress: Callable[[FileState], None] | None = None,
+    ) -> None:
+        """Configure the parallelism of each stage and the size of the queues between them.
+
+        Each queue holds up to `queue_frames` frames, as items of at most `batch_size` frames each.
+
+        `on_progress` is called with the state of a file every time some of its frames were decoded,
+        captioned or added to the index. With `vectors`, the signature of every indexed frame (its
+        perceptual hash, and its embedding when the store keeps them) is added to the vector store.
+        Consecutive frames of a video whose captions are at least `segment_similarity` similar
+        are indexed as one segment document, see `merge_frames`.
+        """
+        self.add_fn = add_fn
+        self.model = model
+        self.sampler = sampler
+        self.segment_similarity = segment_similarity
+        self.caption_cache = caption_cache
+        self.previews = previews
+        self.vectors = vectors
+        self.batch_size = batch_size
+        self.decode_workers = decode_workers
+        self.caption_concurrency = caption_concurrency
+        self.on_progress = on_progress
+        self.queue_size = max(1, queue_frames // batch_size)
+        self.chunks: multiprocessing.queues.Queue | None = None
+        self.captioned: queue.Queue = queue.Queue(maxsize=self.queue_size)
+        self.stats = {name: StageStats(name) for name in ("decode", "caption", "index")}
+        self.ingested: list[Path] = []
+
+    def run(self, files: list[tuple[Path, str, str]]) -> list[Path]:
+        """Ingest `(path, type, sha256)` files and return the paths whose frames all made it into the index.
+
+        The content hashes come from the manifest, they name the previews of each file.
+        """
+        if not files:
+            return []
+        self.chunks = multiprocessing.Queue(maxsize=self.queue_size)
+        decoder = threading.Thread(target=self._decode_stage, args=(files,), name="ingest-decode", daemon=True)
+        captioner = threading.Thread(
+            target=asyncio.run,
+            args=(self._caption_loop(files),),
+            name="ingest-caption",
+            daemon=True,
+        )
+        decoder.start()
+        captioner.start()
+        self._index_stage()
+        decoder.join()
+        captioner.join()
+        self.chunks.close()
+        for stats in self.stats.values():
+            logger.info(f"Ingestion {stats.report()}")
+        return self.ingested
+
+    def _decode_stage(self, files: list[tuple[Path, str, str]]) -> None:
+        """Decode files in a process pool, keeping at most two files per worker outstanding."""
+        with ProcessPoolExecutor(
+            max_workers=self.decode_workers,
+            initializer=_init_decoder,
+            initargs=(self.chunks,),
+        ) as pool:
+            pending: deque[tuple[int, Future]] = deque()
+            for index, (path, typ, digest) in enumerate(files):
+                future = pool.submit(
+                    decode_file,
+                    index,
+                    path,
+                    typ,
+                    digest,
+                    self.model.input_size,
+                    sampler=self.sampler,
+                    chunk_size=self.batch_size,
+                    previews=self.previews,
+                )
+                pending.append((index, future))
+                if len(pending) >= 2 * self.decode_workers:
+                    self._wait_decoded(*pending.popleft())
+            while pending:
+                self._wait_decoded(*pending.popleft())
+        self.stats["decode"].finish()
+        self.chunks.put(None)
+
+    def _wait_decoded(self, index: int, future: Future) -> None:
+        """Wait for a file to be decoded, reporting it failed when its worker died before it could."""
+        try:
+            future.result()
+        except Exception as e:  # noqa: BLE001
+            self.chunks.put(("failed", index, str(e)))
+
+    async def _caption_loop(self, files: list[tuple[Path, str, str]]) -> None:
+        """Run the captioning stage on the event loop of its thread, then close the model client of that loop."""
+        try:
+            await self._caption_stage(files)
+        finally:
+            await self.model.aclose()
+
+    async def _caption_stage(self, files: list[tuple[Path, str, str]]) -> None:
+        """Batch decoded frames across files and keep up to `caption_concurrency` batches in flight."""
+        slots = asyncio.Semaphore(self.caption_concurrency)
+        tasks = set()
+        states: dict[int, FileState] = {}
+        batch: list[tuple[FileState, int]] = []
+        pixels: list[np.ndarray] = []
+
+        async def submit() -> None:
+            await slots.acquire()
+            task = asyncio.create_task(self._caption_batch(batch, pixels, slots))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        while (message := await asyncio.to_thread(self.chunks.get)) is not None:
+            kind, index, payload = message
+            if index not in states:
+                path, typ, _ = files[index]
+                states[index] = FileState(path, typ)
+            state = states[index]
+            if kind == "frames":
+                state.frames += len(payload)
+                self.stats["decode"].frames += len(payload)
+                for timestamp, frame in payload:
+                    batch.append((state, timestamp))
+                    pixels.append(frame)
+                    if len(batch) >= self.batch_size:
+                        await submit()
+                        batch, pixels = [], []
+                self._report([state])
+                continue
+            if kind == "done":
+                state.duration = payload
+                self.stats["decode"].files += 1
+                if state.frames and state.captioned == state.frames:
+                    self.stats["caption"].files += 1
+            else:
+                logger.warning(f"Could not decode {state.path}: {payload}")
+                state.failed = True
+            state.decoded = True
+            self._report([state])
+            await asyncio.to_thread(self.captioned.put, (state, None))
+        if batch:
+            await submit()
+        await asyncio.gather(*tasks)
+        self.stats["caption"].finish()
+        await asyncio.to_thread(self.captioned.put, _DONE)
+
+    async def _caption_batch(
+        self,
+        batch: list[tuple[FileState, int]],
+        pixels: list[np.ndarray],
+        slots: asyncio.Semaphore,
+    ) -> None:
+        """Caption (and embed) one batch, reusing cached captions, and pass it on to the index stage.
+
+        A batch that fails anywhere is passed on without captions, its files are then marked failed.
+        """
+        embeddings = None
+        hashes = None
+        try:
+            if self.caption_cache is not None or self.vectors is not None:
+                hashes = await asyncio.to_thread(lambda: [perceptual_hash(frame) for frame in pixels])
+            if self.vectors is None or not self.vectors.dim:
+                captions = await self._caption_frames(pixels, hashes)
+            else:
+                captions, embeddings = await asyncio.gather(
+                    self._caption_frames(pixels, hashes),
+                    self.model.aembed_images([Image.fromarray(frame) for frame in pixels]),
+                )
+        except Exception as e:  # noqa: BLE001
+            logger.warning(f"Dropping a batch of {len(batch)} frames: {e!s}")
+            captions = None
+        finally:
+            slots.release()
+        stats = self.stats["caption"]
+        stats.frames += len(batch)
+        for state, _ in batch:
+            state.captioned += 1
+            if state.decoded and state.captioned == state.frames:
+                stats.files += 1
+        self._report(state for state, _ in batch)
+        item = (batch, (captions, embeddings, hashes) if captions is not None else None)
+        await asyncio.to_thread(self.captioned.put, item)
+
+    async def _caption_frames(self, pixels: list[np.ndarray], hashes: list[str] | None) -> list[str]:
+        """Caption frames, only sending the ones missing from the caption cache (keyed by `hashes`) to the model."""
+        if self.caption_cache is None:
+            return await self.model.agenerate_captions([Image.fromarray(frame) for frame in pixels])
+        known = await asyncio.to_thread(self.caption_cache.get_many, hashes)
+        missing = {
+            image_hash: frame for image_hash, frame in zip(hashes, pixels, strict=True) if image_hash not in known
+        }
+        if missing:
+            captions = await self.model.agenerate_captions([Image.fromarray(frame) for frame in missing.values()])
+            fresh = dict(zip(missing, captions, strict=True))
+            await asyncio.to_thread(self.caption_cache.put_many, fresh)
+            known.update(fresh)
+        self.stats["caption"].cached += len(pixels) - len(missing)
+        return [known[image_hash] for image_hash in hashes]
+
+    def _index_stage(self) -> None:
+        """Add captioned frames to the index from a single thread."""
+        stats = self.stats["index"]
+        while (item := self.captioned.get()) is not _DONE:
+            batch, captions = item
+            if isinstance(batch, FileState):
+                self._finish(batch)
+                continue
+            if captions is None:
+                for state, _ in batch:
+                    state.failed = True
+            else:
+                self._add_batch(batch, *captions)
+            for state, _ in batch:
+                state.indexed += 1
+                stats.frames += 1
+                self._finish(state)
+        stats.finish()
+
+    def _finish(self, state: FileState) -> None:
+        """Index the segments of a video and record the file once it is decoded and all its frames are indexed."""
+        if state.finished or not state.decoded or state.indexed < state.frames:
+            return
+        state.finished = True
+        if state.pending and not state.failed:
+            self._add_segments(state)
+        self._complete(state)
+
+    def _add_batch(
+        self,
+        batch: list[tuple[FileState, int]],
+        captions: list[str],
+        embeddings: np.ndarray | None,
+        hashes: list[str] | None,
+    ) -> None:
+        """Add the captioned images of a batch, holding video frames back until every frame of their video is in."""
+        docs = Docs()
+        rows = []
+        for row, ((state, timestamp), caption) in enumerate(zip(batch, captions, strict=True)):
+            if state.type == "video":
+                embedding = embeddings[row] if embeddings is not None else None
+                state.pending.append((timestamp, caption, embedding, hashes[row] if hashes is not None else None))
+                continue
+            rows.append(row)
+            self._append_doc(docs, state, caption, (timestamp, timestamp, 1))
+            state.docs += 1
+        if rows:
+            self._add(
+                docs,
+                embeddings[rows] if embeddings is not None else None,
+                [hashes[row] for row in rows] if hashes is not None else None,
+                [state for state, _ in batch],
+            )
+        self._report(state for state, _ in batch)
+
+    def _add_segments(self, state: FileState) -> None:
+        """Index the frames of a video as segments of consecutive frames with near-same captions.
+
+        Every frame keeps its own row in the vector store, labelled with the segment it belongs to.
+        """
+        timestamps, captions, embeddings, hashes = zip(*state.pending, strict=True)
+        state.pending = []
+        docs = Docs()
+        frames = Docs()
+        rows = []
+        segments = merge_frames(timestamps, captions, state.duration, self.segment_similarity)
+        for start, end, caption, segment in segments:
+            self._append_doc(docs, state, caption, (start, end, len(segment)))
+            for _ in segment:
+                self._append_doc(frames, state, caption, (start, end, len(segment)))
+            rows.extend(segment)
+        state.docs += len(docs.texts)
+        self._add(
+            docs,
+            np.stack([embeddings[row] for row in rows]) if embeddings[0] is not None else None,
+            [hashes[row] for row in rows] if hashes[0] is not None else None,
+            [state],
+            frames,
+        )
+        self._report([state])
+
+    @staticmethod
+    def _append_doc(docs: Docs, state: FileState, caption: str, span: tuple[int, int, int]) -> None:
+        """Append the document of a frame or segment of a file, `span` being its (start, end, frames)."""
+        start, end, frames = span
+        docs.texts.append(caption)
+        docs.filenames.append(state.path.name)
+        docs.types.append(state.type)
+        docs.timestamps.append(start)
+        docs.ends.append(end)
+        docs.frames.append(frames)
+        docs.sources.append(state.source)
+
+    def _add(
+        self,
+        docs: Docs,
+        embeddings: np.ndarray | None,
+        hashes: list[str] | None,
+        states: list[FileState],
+        rows: Docs | None = None,
+    ) -> None:
+        """Add documents to the index, and the signatures of their frames to the vector store.
+
+        `rows` describes the frames when there is not one per document, as for video segments.
+        """
+        rows = docs if rows is None else rows
+        try:
+            self.add_fn(docs)
+            if self.vectors is not None and hashes is not None:
+                self.vectors.add(embeddings, hashes, rows)
+        except Exception as e:  # noqa: BLE001
+            logger.warning(f"Could not add {len(docs.texts)} documents: {e!s}")
+            for state in states:
+                state.failed = True
+
+    def _report(self, states: Iterable[FileState]) -> None:
+        """Pass the progress of each distinct file to `on_progress`."""
+        if self.on_progress is None:
+            return
+        for state in dict.fromkeys(states):
+            try:
+                self.on_progress(state)
+            except Exception as e:  # noqa: BLE001
+                logger.warning(f"Could not report the progress of {state.path}: {e!s}")
+
+    def _complete(self, state: FileState) -> None:
+        """Record a file whose every frame went through the pipeline."""
+        if state.failed:
+            return
+        self.stats["index"].files += 1
+        self.ingested.append(state.path)
@@ -0,0 +1,194 @@
+"""Thumbnails, poster frames and preview clips of the media files."""
+
+import os
+import subprocess
+import uuid
+from pathlib import Path
+
+import imageio_ffmpeg
+import numpy as np
+from PIL import Image
+
+IMAGE_FORMATS = {"webp": "WEBP", "jpeg": "JPEG"}
+
+
+def fit(width: int, height: int, size: int) -> tuple[int, int]:
+    """Scale (width, height) down to fit in a `size` x `size` box, keeping the aspect ratio."""
+    scale = min(size / max(width, height), 1)
+    return max(round(width * scale), 1), max(round(height * scale), 1)
+
+
+class PreviewStore:
+    """Content-addressed store of the derived assets of each media file.
+
+    Assets live under `root/<sha256[:2]>/<sha256>/`, keyed by the hash of the original file, so an
+    unchanged file never gets its assets regenerated and a replaced file never shows stale ones.
+    Images get a `thumbnail`, videos a `poster_<t>` still and a `clip_<t>.mp4` clip for every
+    timestamp. Files are written to a temporary name first and renamed, so concurrent writers and
+    readers only ever see complete assets. The store only holds paths and settings, so it can be
+    sent to the decode worker processes.
+    """
+
+    def __init__(  # noqa: PLR0913
+        self,
+        root: Path,
+        *,
+        thumbnail_size: int = 320,
+        image_format: str = "webp",
+        quality: int = 80,
+        clip_seconds: float = 3,
+        clip_size: int = 320,
+        clips_at_ingestion: bool = False,
+    ) -> None:
+        """Store the location and encoding settings of the assets."""
+        self.root = root
+        self.thumbnail_size = thumbnail_size
+        self.image_format = image_format
+        self.quality = quality
+        self.clip_seconds = clip_seconds
+        self.clip_size = clip_size
+        self.clips_at_ingestion = clips_at_ingestion
+
+    def relative_path(self, digest: str, name: str) -> str:
+        """Path of an asset relative to the store root."""
+        return f"{digest[:2]}/{digest}/{name}"
+
+    def thumbnail_name(self, typ: str, timestamp: int = 0) -> str:
+        """Name of the thumbnail of an image or of the poster frame of a video at `timestamp`."""
+        stem = "thumbnail" if typ == "image" else f"poster_{timestamp}"
+        return f"{stem}.{self.image_format}"
+
+    @staticmethod
+    def clip_name(timestamp: int) -> str:
+        """Name of the preview clip of a video starting at `timestamp`."""
+        return f"clip_{timestamp}.mp4"
+
+    def path(self, digest: str, name: str) -> Path:
+        """Absolute location of an asset."""
+        return self.root / self.relative_path(digest, name)
+
+    def _temporary(self, target: Path) -> Path:
+        """Create the directory of `target` and return a unique name next to it."""
+        target.parent.mkdir(parents=True, exist_ok=True)
+        return target.with_name(f".{uuid.uuid4().hex}{target.suffix}")
+
+    def save_image(self, digest: str, name: str, image: Image.Image) -> None:
+        """Encode and store a still."""
+        target = self.path(digest, name)
+        temporary = self._temporary(target)
+        image.save(temporary, format=IMAGE_FORMATS[self.image_format], quality=self.quality)
+        temporary.replace(target)
+
+    def save_thumbnail(self, digest: str, image: Image.Image) -> None:
+        """Store the thumbnail of an already decoded RGB image."""
+        thumbnail = image.copy()
+        thumbnail.thumbnail((self.thumbnail_size, self.thumbnail_size), Image.Resampling.BICUBIC)
+        self.save_image(digest, self.thumbnail_name("image"), thumbnail)
+
+    def save_posters(
+        self,
+        digest: str,
+        frames: list[tuple[int, np.ndarray]],
+        source_size: tuple[int, int],
+    ) -> None:
+        """Store poster frames from video frames decoded at another size, restoring the source aspect ratio."""
+        size = fit(*source_size, self.thumbnail_size)
+        for timestamp, frame in frames:
+            name = self.thumbnail_name("video", timestamp)
+            if not self.path(digest, name).exists():
+                self.save_image(digest, name, Image.fromarray(frame).resize(size, Image.Resampling.BICUBIC))
+
+    def save_clips(self, digest: str, path: Path, timestamps: list[int]) -> None:
+        """Encode the preview clips of a video that are not stored yet."""
+        for timestamp in timestamps:
+            if not self.path(digest, self.clip_name(timestamp)).exists():
+                self.encode_clip(digest, path, timestamp)
+
+    def encode_clip(self, digest: str, path: Path, timestamp: int) -> None:
+        """Cut and re-encode a short, small, silent clip starting at `timestamp` seconds."""
+        target = self.path(digest, self.clip_name(timestamp))
+        temporary = self._temporary(target)
+        size = self.clip_size
+        try:
+            subprocess.run(  # noqa: S603
+                [
+                    imageio_ffmpeg.get_ffmpeg_exe(),
+                    "-nostdin",
+                    "-loglevel",
+                    "error",
+                    "-y",
+                    "-ss",
+                    str(timestamp),
+                    "-t",
+                    str(self.clip_seconds),
+                    "-i",
+                    path.as_posix(),
+                    "-vf",
+                    f"scale=w={size}:h={size}:force_original_aspect_ratio=decrease,scale=trunc(iw/2)*2:trunc(ih/2)*2",
+                    "-an",
+                    "-c:v",
+                    "libx264",
+                    "-preset",
+                    "veryfast",
+                    "-crf",
+                    "28",
+                    "-pix_fmt",
+                    "yuv420p",
+                    "-movflags",
+                    "+faststart",
+                    temporary.as_posix(),
+                ],
+                check=True,
+                capture_output=True,
+            )
+            temporary.replace(target)
+        finally:
+            temporary.unlink(missing_ok=True)
+
+    def ensure_thumbnail(self, digest: str, path: Path, typ: str, timestamp: int = 0) -> str:
+        """Return the relative path of a thumbnail or poster frame, creating it from the original if missing."""
+        name = self.thumbnail_name(typ, timestamp)
+        if self.path(digest, name).exists():
+            return self.relative_path(digest, name)
+        if typ == "image":
+            with Image.open(path) as image:
+                self.save_thumbnail(digest, image.convert("RGB"))
+            return self.relative_path(digest, name)
+        size = self.thumbnail_size
+        reader = imageio_ffmpeg.read_frames(
+            path.as_posix(),
+            pix_fmt="rgb24",
+            input_params=["-ss", str(timestamp)],
+            output_params=["-frames:v", "1", "-vf", f"scale=w={size}:h={size}:force_original_aspect_ratio=decrease"],
+        )
+        try:
+            width, height = next(reader)["size"]
+            frame = np.frombuffer(next(reader), dtype=np.uint8).reshape(height, width, 3)
+        except StopIteration as e:
+            msg = f"{path} has no frame at {timestamp}s"
+            raise FileNotFoundError(msg) from e
+        finally:
+            reader.close()
+        self.save_image(digest, name, Image.fromarray(frame))
+        return self.relative_path(digest, name)
+
+    def ensure_clip(self, digest: str, path: Path, timestamp: int) -> str:
+        """Return the relative path of a preview clip, encoding it if missing."""
+        name = self.clip_name(timestamp)
+        if not self.path(digest, name).exists():
+            self.encode_clip(digest, path, timestamp)
+        return self.relative_path(digest, name)
+
+
+def remove_unreferenced(root: Path, digests: set[str]) -> int:
+    """Delete the assets of files that are no longer in the manifest, returns the number of files deleted."""
+    removed = 0
+    for shard in root.glob("??"):
+        for directory in shard.iterdir():
+            if directory.name in digests:
+                continue
+            for file in directory.iterdir():
+                file.unlink(missing_ok=True)
+                removed += 1
+            os.rmdir(directory)  # noqa: PTH106
+    return removed
@@ -0,0 +1,147 @@
+"""Cache of query results."""
+
+import asyncio
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+
+def cache_key(text: str, typ: str, n: int, mode: str = "bm25") -> str:
+    """Normalize a query into a cache key.
+
+    Only whitespace is normalized, case is kept because the query parser treats `AND`/`OR` as operators.
+    """
+    return json.dumps([" ".join(text.split()), typ, n, mode])
+
+
+class SharedQueryCache:
+    """SQLite backed cache that lets every uvicorn worker reuse results computed by the others."""
+
+    def __init__(self, path: Path, max_size: int, ttl: float) -> None:
+        """Open (or create) the shared cache database."""
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path.as_posix(), check_same_thread=False, timeout=1)
+        with self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "key TEXT NOT NULL, generation TEXT NOT NULL, expires_at REAL NOT NULL, value TEXT NOT NULL, "
+                "PRIMARY KEY (key, generation))",
+            )
+
+    def get(self, key: str, generation: str) -> list[dict] | None:
+        """Look up results computed against the given index generation."""
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT value FROM results WHERE key = ? AND generation = ? AND expires_at > ?",
+                (key, generation, time.time()),
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, key: str, generation: str, results: list[dict]) -> None:
+        """Store results and trim expired or excess entries."""
+        now = time.time()
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO results (key, generation, expires_at, value) VALUES (?, ?, ?, ?)",
+                (key, generation, now + self.ttl, json.dumps(results)),
+            )
+            self.connection.execute("DELETE FROM results WHERE expires_at <= ?", (now,))
+            self.connection.execute(
+                "DELETE FROM results WHERE rowid NOT IN (SELECT rowid FROM results ORDER BY expires_at DESC LIMIT ?)",
+                (self.max_size,),
+            )
+
+
+class QueryCache:
+    """Bounded LRU cache of query results with a TTL.
+
+    Entries belong to one index generation, the whole cache is dropped as soon as a different
+    generation is seen so results never outlive the commit they were computed against.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 300, shared: SharedQueryCache | None = None) -> None:
+        """Initialize an empty cache."""
+        self.max_size = max_size
+        self.ttl = ttl
+        self.shared = shared
+        self.lock = threading.Lock()
+        self.entries: OrderedDict[str, tuple[float, list[dict]]] = OrderedDict()
+        self.generation: str | None = None
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _sync(self, generation: str) -> None:
+        """Drop every entry if the index moved to another generation. Caller holds the lock."""
+        if generation != self.generation:
+            self.entries.clear()
+            self.generation = generation
+
+    def _store(self, key: str, results: list[dict]) -> None:
+        """Insert an entry, evicting the least recently used ones. Caller holds the lock."""
+        self.entries[key] = (time.monotonic() + self.ttl, results)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    async def get(self, key: str, generation: str) -> list[dict] | None:
+        """Return cached results for `key`, or None on a miss.
+
+        The shared cache is read in a thread so the event loop never waits on SQLite.
+        """
+        with self.lock:
+            self._sync(generation)
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self.entries[key]
+        if self.shared is not None:
+            results = await asyncio.to_thread(self.shared.get, key, generation)
+            if results is not None:
+                with self.lock:
+                    self._sync(generation)
+                    self._store(key, results)
+                    self.shared_hits += 1
+                return results
+        with self.lock:
+            self.misses += 1
+        return None
+
+    async def put(self, key: str, generation: str, results: list[dict]) -> None:
+        """Cache the results of a query, writing the shared cache in a thread."""
+        with self.lock:
+            self._sync(generation)
+            self._store(key, results)
+        if self.shared is not None:
+            await asyncio.to_thread(self.shared.put, key, generation, results)
+
+    def clear(self) -> None:
+        """Drop every local entry, used after a commit in this process."""
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self) -> dict:
+        """Hit-rate metrics of this worker."""
+        with self.lock:
+            lookups = self.hits + self.shared_hits + self.misses
+            return {
+                "size": len(self.entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "shared_hits": self.shared_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": (self.hits + self.shared_hits) / lookups if lookups else 0.0,
+            }
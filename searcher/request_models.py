@@ -10,6 +10,7 @@ class Query(BaseModel):
     text: str = Field(default="", strict=True)
     type: Literal["image", "video"] = "image"
     n: int = Field(default=10, strict=True)
+    mode: Literal["bm25", "dense", "hybrid"] = "bm25"
 
 class Docs(BaseModel):
     """Documents Class."""
@@ -18,3 +19,6 @@ class Docs(BaseModel):
     filenames: list[str] = Field(default=[], strict=True)
     types: list[str] = Field(default=[], strict=True)
     timestamps: list[int] = Field(default=[], strict=True)
+    ends: list[int] = Field(default=[], strict=True)
+    frames: list[int] = Field(default=[], strict=True)
+    sources: list[str] = Field(default=[], strict=True)
@@ -0,0 +1,39 @@
+"""Grouping of consecutive video frames with the same caption into time segments."""
+
+from collections import Counter
+
+
+def caption_similarity(caption: str, other: str) -> float:
+    """Jaccard similarity of the words of two captions."""
+    words, other_words = set(caption.lower().split()), set(other.lower().split())
+    return len(words & other_words) / len(words | other_words) if words | other_words else 1.0
+
+
+def merge_frames(
+    timestamps: list[int],
+    captions: list[str],
+    duration: int = 0,
+    min_similarity: float = 1.0,
+) -> list[tuple[int, int, str, list[int]]]:
+    """Merge runs of consecutive frames with near-same captions into `(start, end, caption, rows)` segments.
+
+    Frames are ordered by timestamp first, whatever order they were captioned in, and `rows` are
+    their positions in the given lists. A frame joins the current segment when its caption is at
+    least `min_similarity` similar to the caption the segment started with. A segment ends where the
+    next one starts, the last one at `duration` (or at its last frame). Its caption is the most
+    frequent one among its frames.
+    """
+    order = sorted(range(len(timestamps)), key=lambda row: timestamps[row])
+    runs: list[list[int]] = []
+    for row in order:
+        if runs and caption_similarity(captions[runs[-1][0]], captions[row]) >= min_similarity:
+            runs[-1].append(row)
+        else:
+            runs.append([row])
+    segments = []
+    for index, rows in enumerate(runs):
+        start = timestamps[rows[0]]
+        end = timestamps[runs[index + 1][0]] if index + 1 < len(runs) else max(duration, timestamps[rows[-1]])
+        caption = Counter(captions[row] for row in rows).most_common(1)[0][0]
+        segments.append((start, end, caption, rows))
+    return segments
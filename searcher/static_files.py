@@ -0,0 +1,151 @@
+"""Static media files served from an in-memory cache."""
+
+import os
+import stat
+import threading
+from collections import OrderedDict
+
+from fastapi.staticfiles import StaticFiles
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import NotModifiedResponse
+from starlette.types import Scope
+
+OK = 200
+PARTIAL_CONTENT = 206
+RANGE_NOT_SATISFIABLE = 416
+
+
+def parse_range(header: str, size: int) -> tuple[int, int] | None:
+    """Resolve a single `bytes=` range against a file of `size` bytes into an inclusive (start, end).
+
+    Returns None for headers this cache does not serve partially (other units, several ranges or
+    malformed values), in which case the whole file is sent as allowed by RFC 9110. Raises
+    ValueError for a well-formed range that lies outside the file.
+    """
+    unit, _, ranges = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in ranges:
+        return None
+    first, _, last = ranges.strip().partition("-")
+    try:
+        if not first:
+            start, end = max(size - int(last), 0), size - 1
+        else:
+            start, end = int(first), min(int(last), size - 1) if last else size - 1
+    except ValueError:
+        return None
+    if start < 0 or start > end:
+        if start >= size:
+            raise ValueError(header)
+        return None
+    return start, end
+
+
+class CachingStaticFiles(StaticFiles):
+    """Serve files up to `max_file_bytes` from a least-recently-used cache of their contents.
+
+    The cache holds at most `max_bytes` of file contents. Entries are keyed by path and checked
+    against the size and mtime of every lookup, so a replaced file is never served stale. Cached
+    files honour If-None-Match / If-Modified-Since and single byte ranges (for video seeking)
+    without touching the file, larger files are streamed from disk by `FileResponse`, which
+    handles both as well. Both paths emit the same ETag and Last-Modified headers.
+    """
+
+    def __init__(
+        self,
+        *args: object,
+        max_bytes: int = 128 << 20,
+        max_file_bytes: int = 8 << 20,
+        **kwargs: object,
+    ) -> None:
+        """Initialize the static files app and its byte budget."""
+        super().__init__(*args, **kwargs)
+        self.max_bytes = max_bytes
+        self.max_file_bytes = min(max_file_bytes, max_bytes)
+        self.cache: OrderedDict[str, tuple[int, int, bytes]] = OrderedDict()
+        self.cached_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def lookup_path(self, path: str) -> tuple[str, os.stat_result | None]:
+        """Find the file and load small ones into the cache, this runs in a worker thread."""
+        full_path, stat_result = super().lookup_path(path)
+        if stat_result is not None and stat.S_ISREG(stat_result.st_mode) and stat_result.st_size <= self.max_file_bytes:
+            self._load(full_path, stat_result)
+        return full_path, stat_result
+
+    def _load(self, full_path: str, stat_result: os.stat_result) -> None:
+        """Make sure the cache holds the current contents of a file."""
+        version = (stat_result.st_mtime_ns, stat_result.st_size)
+        with self.lock:
+            entry = self.cache.get(full_path)
+            if entry is not None and entry[:2] == version:
+                self.cache.move_to_end(full_path)
+                self.hits += 1
+                return
+            self.misses += 1
+        with open(full_path, "rb") as file:  # noqa: PTH123
+            content = file.read()
+        if len(content) != stat_result.st_size:
+            return
+        with self.lock:
+            previous = self.cache.pop(full_path, None)
+            if previous is not None:
+                self.cached_bytes -= len(previous[2])
+            self.cache[full_path] = (*version, content)
+            self.cached_bytes += len(content)
+            while self.cached_bytes > self.max_bytes:
+                _, evicted = self.cache.popitem(last=False)
+                self.cached_bytes -= len(evicted[2])
+
+    def file_response(
+        self,
+        full_path: os.PathLike,
+        stat_result: os.stat_result,
+        scope: Scope,
+        status_code: int = OK,
+    ) -> Response:
+        """Answer from the cache when the file is in it, otherwise stream it from disk."""
+        with self.lock:
+            entry = self.cache.get(os.fspath(full_path))
+        if entry is None or entry[:2] != (stat_result.st_mtime_ns, stat_result.st_size):
+            return super().file_response(full_path, stat_result, scope, status_code)
+        content = entry[2]
+        headers = FileResponse(full_path, status_code=status_code, stat_result=stat_result).headers
+        request_headers = Headers(scope=scope)
+        if self.is_not_modified(headers, request_headers):
+            return NotModifiedResponse(headers)
+        headers = dict(headers)
+        range_header = request_headers.get("range")
+        if_range = request_headers.get("if-range")
+        if range_header and status_code == OK and if_range in (None, headers["etag"], headers["last-modified"]):
+            try:
+                byte_range = parse_range(range_header, len(content))
+            except ValueError:
+                return Response(
+                    status_code=RANGE_NOT_SATISFIABLE,
+                    headers={"content-range": f"bytes */{len(content)}"},
+                )
+            if byte_range is not None:
+                start, end = byte_range
+                content = content[start : end + 1]
+                status_code = PARTIAL_CONTENT
+                headers["content-range"] = f"bytes {start}-{end}/{len(entry[2])}"
+        headers["content-length"] = str(len(content))
+        if scope["method"] == "HEAD":
+            content = b""
+        return Response(content, status_code=status_code, headers=headers)
+
+    def stats(self) -> dict:
+        """Report the cache usage and hit rate."""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "files": len(self.cache),
+                "bytes": self.cached_bytes,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
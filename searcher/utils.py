@@ -1,22 +1,26 @@
-"""Video and Image adders."""
+"""Client of the captioning and embedding model service and media paths."""
 
+import asyncio
 import base64
-import os
-from collections.abc import Callable
+import time
 from io import BytesIO
 from pathlib import Path
 
 import httpx
 import numpy as np
 from fastapi.exceptions import HTTPException
-from moviepy.editor import VideoFileClip
+from loguru import logger
 from PIL import Image
-from request_models import Docs
 
 VIDEOS_PATH = Path("..", "data", "videos")
 IMAGES_PATH = Path("..", "data", "images")
-INTERVAL = 5
 ACCEPTED = 200
+TOO_MANY_REQUESTS = 429
+SERVER_ERROR = 500
+
+
+class CaptioningError(Exception):
+    """The model service could not caption (or embed) a batch."""
 
 
 class Blip:
@@ -31,6 +35,21 @@ class Blip:
             + str(config["model"]["port"])
             + "/generate_captions"
         )
+        self.raw_service = self.service + "/raw"
+        base_url = self.service.removesuffix("/generate_captions")
+        self.embed_images_service = base_url + "/embed_images/raw"
+        self.embed_texts_service = base_url + "/embed_texts"
+        self.ready_service = base_url + "/ready"
+        self.transport = config["captioning"]["transport"]
+        self.input_size = config["captioning"]["input_size"]
+        self.retries = config["captioning"]["retries"]
+        self.retry_backoff = config["captioning"]["retry_backoff"]
+        max_in_flight = config["captioning"]["max_in_flight"]
+        self.limits = httpx.Limits(max_connections=max_in_flight, max_keepalive_connections=max_in_flight)
+        self.client = httpx.Client(limits=self.limits, timeout=httpx.Timeout(120))
+        self.max_in_flight = max_in_flight
+        # Async clients and semaphores only work on the loop they were created on, so each loop gets its own.
+        self.sessions: dict[asyncio.AbstractEventLoop, tuple[httpx.AsyncClient, asyncio.Semaphore]] = {}
 
     def encode(self, image: Image.Image) -> str:
         """Convert PIL image to bytes (base64) then to string."""
@@ -38,6 +57,19 @@ class Blip:
         image.save(buffer, format="PNG")
         return base64.b64encode(buffer.getvalue()).decode("utf-8")
 
+    def encode_raw(self, images: list[Image.Image]) -> tuple[bytes, str]:
+        """Convert PIL images to concatenated RGB pixels at the model input size and their shapes header."""
+        buffers = []
+        shapes = []
+        for image in images:
+            pixels = image.convert("RGB").resize(
+                (self.input_size, self.input_size),
+                Image.Resampling.BICUBIC,
+            )
+            buffers.append(pixels.tobytes())
+            shapes.append(f"{pixels.height},{pixels.width},3")
+        return b"".join(buffers), ";".join(shapes)
+
     def raise_http_exception(self, response: httpx.Response) -> None:
         """Raise an HTTPException."""
         raise HTTPException(
@@ -45,103 +77,114 @@ class Blip:
             detail=response.text,
         )
 
-    def generate_captions(self, image_list: list[Image.Image]) -> list[str]:
-        """Generate captions for the given image."""
-        try:
-            images = [self.encode(image) for image in image_list]
-            response = httpx.post(
-                url=self.service,
-                json={"images": images},
-                timeout=httpx.Timeout(120),
-            )
-            if response.status_code != ACCEPTED:
-                self.raise_http_exception(response)
-            return response.json()["captions"]
-        except HTTPException:
-            return []
+    def build_request(self, image_list: list[Image.Image]) -> dict:
+        """Encode the images into the arguments of a POST to the model service."""
+        if self.transport == "raw":
+            body, shapes = self.encode_raw(image_list)
+            return {
+                "url": self.raw_service,
+                "content": body,
+                "headers": {"Content-Type": "application/octet-stream", "X-Image-Shapes": shapes},
+            }
+        return {"url": self.service, "json": {"images": [self.encode(image) for image in image_list]}}
+
+    def parse_response(self, response: httpx.Response, expected: int) -> list[str]:
+        """Extract the captions from a response of the model service."""
+        if response.status_code != ACCEPTED:
+            self.raise_http_exception(response)
+        captions = response.json()["captions"]
+        if len(captions) != expected:
+            error = f"Expected {expected} captions but the model service returned {len(captions)}"
+            raise CaptioningError(error)
+        return captions
 
+    def should_retry(self, error: Exception, attempt: int) -> bool:
+        """Retry transport errors, throttling and server errors until the retries run out."""
+        if attempt >= self.retries:
+            return False
+        if isinstance(error, httpx.TransportError):
+            return True
+        return isinstance(error, HTTPException) and (
+            error.status_code == TOO_MANY_REQUESTS or error.status_code >= SERVER_ERROR
+        )
 
-def video_adder(add_fn: Callable, batch_size: int, model: Blip) -> None:
-    """Get captions for video frames at varying times batch-wise and add them in the tantivy index."""
-    for dirpath, _dirnames, filenames in os.walk(VIDEOS_PATH):
-        images = []
-        fnames = []
-        tstamps = []
-        unique_captions = set()
-        for filename in filenames:
+    def wait_until_ready(self, timeout: float, interval: float = 1) -> bool:
+        """Poll the readiness of the model service for up to `timeout` seconds, returns whether it became ready."""
+        deadline = time.monotonic() + timeout
+        while True:
             try:
-                path = Path(dirpath, filename)
-                video = VideoFileClip(path.as_posix())
-                for t in np.arange(0, video.duration, INTERVAL):  # capture every 5 seconds
-                    frame = video.get_frame(t)
-                    image = Image.fromarray(frame)
-                    images.append(image)
-                    fnames.append(filename)
-                    tstamps.append(t)
-                    if len(images) >= batch_size:
-                        batch_captions = model.generate_captions(images)
-                        documents = (
-                            set(zip(batch_captions, fnames, strict=False)) - unique_captions
-                        )
-                        unique_captions |= documents
-                        batch_captions, fnames = map(list, zip(*documents, strict=False))
-                        docs = Docs(
-                            texts=batch_captions,
-                            filenames=fnames,
-                            types=["video"] * batch_size,
-                            timestamps=tstamps,
-                        )
-                        add_fn(docs)
-                        images = []
-                        fnames = []
-                        tstamps = []
-            except (Exception, BaseException):
-                continue
-            video.close()
-        if len(images) > 0:
-            batch_captions = model.generate_captions(images)
-            documents = set(zip(batch_captions, fnames, strict=False)) - unique_captions
-            unique_captions |= documents
-            batch_captions, fnames = map(list, zip(*documents, strict=False))
-            docs = Docs(
-                texts=batch_captions,
-                filenames=fnames,
-                types=["video"] * len(batch_captions),
-                timestamps=tstamps,
-            )
-            add_fn(docs)
+                if self.client.get(self.ready_service, timeout=interval).status_code == ACCEPTED:
+                    return True
+            except httpx.TransportError:
+                pass
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(interval)
 
+    def session(self) -> tuple[httpx.AsyncClient, asyncio.Semaphore]:
+        """Return the async client and in-flight semaphore of the running event loop, creating them on first use."""
+        loop = asyncio.get_running_loop()
+        if loop not in self.sessions:
+            client = httpx.AsyncClient(limits=self.limits, timeout=httpx.Timeout(120))
+            self.sessions[loop] = (client, asyncio.Semaphore(self.max_in_flight))
+        return self.sessions[loop]
 
-def image_adder(add_fn: Callable, batch_size: int, model: Blip) -> None:
-    """Get captions for images batch-wise and add them in the tantivy index."""
-    for dirpath, _dirnames, filenames in os.walk(IMAGES_PATH):
-        images = []
-        fnames = []
-        for filename in filenames:
+    async def aclose(self) -> None:
+        """Close the async client of the running event loop, to be awaited before a short-lived loop ends."""
+        session = self.sessions.pop(asyncio.get_running_loop(), None)
+        if session is not None:
+            await session[0].aclose()
+
+    async def apost(self, request: dict, task: str = "Captioning") -> httpx.Response:
+        """POST to the model service with up to `max_in_flight` requests outstanding, retrying failures."""
+        client, in_flight = self.session()
+        attempt = 0
+        while True:
             try:
-                path = Path(dirpath, filename)
-                image = Image.open(path)
-                images.append(image)
-                fnames.append(filename)
-                if len(images) >= batch_size:
-                    batch_captions = model.generate_captions(images)
-                    docs = Docs(
-                        texts=batch_captions,
-                        filenames=fnames,
-                        types=["image"] * batch_size,
-                        timestamps=[0] * len(batch_captions),
-                    )
-                    add_fn(docs)
-                    images = []
-                    fnames=[]
-            except (Exception, BaseException):
-                continue
-        if len(images) > 0:
-            batch_captions = model.generate_captions(images)
-            docs = Docs(
-                texts=batch_captions,
-                filenames=fnames,
-                types=["image"] * len(batch_captions),
-                timestamps=[0] * len(batch_captions),
-            )
-            add_fn(docs)
+                async with in_flight:
+                    response = await client.post(**request)
+                if response.status_code != ACCEPTED:
+                    self.raise_http_exception(response)
+            except (httpx.TransportError, HTTPException) as e:
+                if not self.should_retry(e, attempt):
+                    error = f"{task} failed after {attempt + 1} attempts: {e!s}"
+                    raise CaptioningError(error) from e
+                logger.warning(f"{task} attempt {attempt + 1} failed, retrying: {e!s}")
+                await asyncio.sleep(self.retry_backoff * 2**attempt)
+                attempt += 1
+            else:
+                return response
+
+    async def agenerate_captions(self, image_list: list[Image.Image]) -> list[str]:
+        """Generate captions for the given images without blocking the event loop."""
+        if not image_list:
+            return []
+        request = await asyncio.to_thread(self.build_request, image_list)
+        return self.parse_response(await self.apost(request), len(image_list))
+
+    @staticmethod
+    def parse_embeddings(response: httpx.Response, expected: int) -> np.ndarray:
+        """Read the float32 matrix of a response of the embedding endpoints."""
+        rows, dim = (int(size) for size in response.headers["X-Embedding-Shape"].split(","))
+        if rows != expected:
+            error = f"Expected {expected} embeddings but the model service returned {rows}"
+            raise CaptioningError(error)
+        return np.frombuffer(response.content, dtype=np.float32).reshape(rows, dim)
+
+    async def aembed_images(self, image_list: list[Image.Image]) -> np.ndarray:
+        """Embed images into unit-norm vectors, sent as raw pixels at the model input size."""
+        if not image_list:
+            return np.empty((0, 0), dtype=np.float32)
+        body, shapes = await asyncio.to_thread(self.encode_raw, image_list)
+        request = {
+            "url": self.embed_images_service,
+            "content": body,
+            "headers": {"Content-Type": "application/octet-stream", "X-Image-Shapes": shapes},
+        }
+        return self.parse_embeddings(await self.apost(request, "Embedding"), len(image_list))
+
+    async def aembed_texts(self, texts: list[str]) -> np.ndarray:
+        """Embed texts into the same space as the images."""
+        request = {"url": self.embed_texts_service, "json": {"texts": texts}}
+        return self.parse_embeddings(await self.apost(request, "Embedding"), len(texts))
+
@@ -0,0 +1,518 @@
+"""Memory-mapped store of frame signatures (embeddings and perceptual hashes) and their nearest-neighbour search."""
+
+import sqlite3
+import threading
+from collections.abc import Iterable
+from pathlib import Path
+
+import numpy as np
+from caption_cache import HASH_SIZE
+from loguru import logger
+from request_models import Docs
+
+DTYPES = {"float16": np.float16, "int8": np.int8}
+# Unit-norm components lie in [-1, 1], int8 stores them scaled by this factor.
+INT8_SCALE = 127
+TYPE_CODES = {"image": 0, "video": 1}
+CHUNK_ROWS = 1 << 16
+KMEANS_ITERATIONS = 10
+KMEANS_SAMPLE_PER_LIST = 64
+# Loads of the view retried when a rewrite deletes the files being mapped.
+REFRESH_ATTEMPTS = 3
+HASH_WORDS = HASH_SIZE * HASH_SIZE // 64
+# Bump whenever the columns of the rows table change, the store then starts over.
+ROWS_VERSION = 2
+
+
+def quantize(embeddings: np.ndarray, dtype: str) -> np.ndarray:
+    """Convert unit-norm float32 vectors to the storage type."""
+    if dtype == "int8":
+        return np.clip(np.rint(embeddings * INT8_SCALE), -INT8_SCALE, INT8_SCALE).astype(np.int8)
+    return embeddings.astype(np.float16)
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    """Return the indices of the `k` highest scores, best first."""
+    candidates = np.argpartition(-scores, k)[:k] if len(scores) > k else np.arange(len(scores))
+    return candidates[np.argsort(-scores[candidates], kind="stable")]
+
+
+def top_k_distinct(scores: np.ndarray, groups: np.ndarray, k: int) -> np.ndarray:
+    """Return the indices of the `k` highest scores keeping only the best one of each group, best first.
+
+    Once the best `size` scores span `k` groups, no other row can beat them, so only as many rows
+    are sorted as it takes to get there.
+    """
+    size = k
+    while True:
+        order = top_k(scores, size)
+        _, first = np.unique(groups[order], return_index=True)
+        if len(first) >= k or size >= len(scores):
+            return order[np.sort(first)[:k]]
+        size *= 4
+
+
+def segment_ids(first_id: int, keys: list[tuple]) -> list[int]:
+    """Give consecutive rows sharing a (source, timestamp) key the id of the first of them."""
+    ids: list[int] = []
+    previous = None
+    for row_id, key in enumerate(keys, start=first_id):
+        ids.append(ids[-1] if key == previous else row_id)
+        previous = key
+    return ids
+
+
+def reciprocal_rank_fusion(rankings: list[list[dict]], n: int, k: int = 60) -> list[dict]:
+    """Merge ranked result lists, scoring every (filename, timestamp) by the sum of 1 / (k + rank)."""
+    fused: dict[tuple, dict] = {}
+    for ranking in rankings:
+        for rank, result in enumerate(ranking, start=1):
+            key = (result["filename"], result["timestamp"])
+            entry = fused.setdefault(key, result | {"score": 0.0})
+            entry["score"] += 1 / (k + rank)
+    return sorted(fused.values(), key=lambda result: result["score"], reverse=True)[:n]
+
+
+class VectorStore:
+    """Append-only signatures of the indexed frames: a unit-norm embedding and a perceptual hash per row.
+
+    The vectors are stored as float16 (or int8) rows in a flat file that readers memory-map, the
+    256-bit hashes in a second one, and the metadata of every row lives in SQLite next to them. With
+    `dim` 0 only the hashes are kept. Rows of deleted files are only flagged dead and
+    dropped when `maintain` rewrites the matrix into a new file, so readers never see a file change
+    under them. Only the ingesting process writes, every uvicorn worker reads and notices appends,
+    deletions and rewrites through counters in the metadata table.
+
+    Search scans the matrix in chunks with NumPy. Beyond `ivf_min_rows` rows, `maintain` trains an
+    inverted file index (k-means centroids) and queries only scan the rows of the `nprobe` lists
+    closest to the query.
+    """
+
+    def __init__(  # noqa: PLR0913
+        self,
+        root: Path,
+        dim: int,
+        *,
+        dtype: str = "float16",
+        model: str = "",
+        nlist: int = 1024,
+        nprobe: int = 16,
+        ivf_min_rows: int = 100_000,
+    ) -> None:
+        """Open (or create) the store, starting over if it was built with other settings."""
+        root.mkdir(parents=True, exist_ok=True)
+        self.root = root
+        self.dim = dim
+        self.dtype = dtype
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.ivf_min_rows = ivf_min_rows
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+        self.connection = sqlite3.connect((root / "rows.sqlite3").as_posix(), check_same_thread=False, timeout=5)
+        with self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self._create_rows()
+            self.connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+        settings = f"{model}:{dim}:{dtype}:dhash{HASH_SIZE}:rows{ROWS_VERSION}"
+        if self._meta("settings") != settings:
+            self._reset(settings)
+        self.loaded: tuple[int, int] | None = None
+        self.matrix: np.ndarray | None = None
+        self.hashes: np.ndarray | None = None
+        self.alive = np.zeros(0, dtype=bool)
+        self.types = np.zeros(0, dtype=np.uint8)
+        self.lists = np.zeros(0, dtype=np.int32)
+        self.segments = np.zeros(0, dtype=np.int64)
+        self.centroids: np.ndarray | None = None
+        self.deletes = -1
+
+    @property
+    def row_bytes(self) -> int:
+        """Size of one stored vector."""
+        return self.dim * np.dtype(DTYPES[self.dtype]).itemsize
+
+    def _meta(self, key: str) -> str | None:
+        """Read a metadata value."""
+        with self.lock:
+            row = self.connection.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, values: dict[str, object]) -> None:
+        """Write metadata values inside the current transaction."""
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+            [(key, str(value)) for key, value in values.items()],
+        )
+
+    def _path(self, epoch: int) -> Path:
+        """File holding the matrix written at `epoch`."""
+        return self.root / f"vectors-{epoch}.bin"
+
+    def _hash_path(self, epoch: int) -> Path:
+        """File holding the perceptual hashes written at `epoch`."""
+        return self.root / f"hashes-{epoch}.bin"
+
+    def _create_rows(self) -> None:
+        """Create the table describing every row, inside the current transaction.
+
+        A row is a frame, `timestamp`, `end` and `frames` describe the segment of the video it belongs to
+        and `segment` is the id of the first row of that segment, so that searches return each segment once.
+        """
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS rows ("
+            "id INTEGER PRIMARY KEY, source TEXT NOT NULL, filename TEXT NOT NULL, type TEXT NOT NULL, "
+            "timestamp INTEGER NOT NULL, end INTEGER NOT NULL, frames INTEGER NOT NULL, caption TEXT NOT NULL, "
+            "list INTEGER NOT NULL DEFAULT -1, segment INTEGER NOT NULL, alive INTEGER NOT NULL DEFAULT 1)",
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS rows_source ON rows (source)")
+
+    def _reset(self, settings: str) -> None:
+        """Drop every vector, used when the model or storage settings changed."""
+        logger.info(f"Starting a new vector store at {self.root}")
+        with self.lock, self.connection:
+            # Recreated rather than emptied, the columns may have changed along with the settings.
+            self.connection.execute("DROP TABLE rows")
+            self._create_rows()
+            self._set_meta({"settings": settings, "epoch": 0, "rows": 0, "deletes": 0, "centroids": ""})
+        for path in [*self.root.glob("vectors-*.bin"), *self.root.glob("hashes-*.bin")]:
+            path.unlink()
+        self._path(0).touch()
+        self._hash_path(0).touch()
+
+    def generation(self) -> str:
+        """Identify the current contents, changes on every add, delete and rewrite."""
+        with self.lock:
+            rows = dict(
+                self.connection.execute("SELECT key, value FROM meta WHERE key IN ('epoch', 'rows', 'deletes')"),
+            )
+        return f"{rows.get('epoch')}.{rows.get('rows')}.{rows.get('deletes')}"
+
+    def add(self, embeddings: np.ndarray | None, hashes: list[str], rows: Docs) -> None:
+        """Append the signatures of frames (embeddings are ignored when `dim` is 0) and the documents of their rows."""
+        if not hashes:
+            return
+        centroids = self._load_centroids()
+        lists = (
+            np.argmax(embeddings @ centroids.T, axis=1).tolist() if centroids is not None else [-1] * len(hashes)
+        )
+        with self.lock, self.connection:
+            epoch, count = (
+                int(value)
+                for (value,) in self.connection.execute(
+                    "SELECT value FROM meta WHERE key IN ('epoch', 'rows') ORDER BY key",
+                )
+            )
+            columns = [(self._hash_path(epoch), 8 * HASH_WORDS, b"".join(bytes.fromhex(h) for h in hashes))]
+            if self.dim:
+                columns.append((self._path(epoch), self.row_bytes, quantize(embeddings, self.dtype).tobytes()))
+            for path, row_bytes, data in columns:
+                with path.open("r+b") as file:
+                    # Rows written by an interrupted add were never committed, overwrite them.
+                    file.seek(count * row_bytes)
+                    file.write(data)
+                    file.truncate()
+            self.connection.executemany(
+                "INSERT INTO rows (id, source, filename, type, timestamp, end, frames, caption, list, segment) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                zip(
+                    range(count, count + len(hashes)),
+                    rows.sources,
+                    rows.filenames,
+                    rows.types,
+                    rows.timestamps,
+                    rows.ends,
+                    rows.frames,
+                    rows.texts,
+                    lists,
+                    segment_ids(count, list(zip(rows.sources, rows.timestamps, strict=True))),
+                    strict=True,
+                ),
+            )
+            self._set_meta({"rows": count + len(hashes)})
+
+    def delete_sources(self, sources: Iterable[str]) -> None:
+        """Flag the vectors of the given files as deleted."""
+        rows = [(source,) for source in sources]
+        if not rows:
+            return
+        with self.lock, self.connection:
+            self.connection.executemany("UPDATE rows SET alive = 0 WHERE source = ? AND alive = 1", rows)
+            self.connection.execute("UPDATE meta SET value = CAST(value AS INTEGER) + 1 WHERE key = 'deletes'")
+
+    def maintain(self) -> None:
+        """Rewrite the matrix without dead rows once they make up half of it, and (re)train the IVF when due."""
+        with self.lock:
+            total, alive = self.connection.execute("SELECT COUNT(*), COALESCE(SUM(alive), 0) FROM rows").fetchone()
+        trained_rows = int(self._meta("trained_rows") or 0)
+        # Train once the corpus is large enough and again whenever it quadrupled since.
+        train = self.dim > 0 and alive >= self.ivf_min_rows and alive >= 4 * trained_rows
+        if train or total - alive > alive:
+            self._rewrite(train=self.dim > 0 and alive >= self.ivf_min_rows)
+
+    def _rewrite(self, *, train: bool) -> None:
+        """Copy the live rows into a new epoch, assigning them to freshly trained IVF lists if `train`."""
+        with self.lock:
+            epoch = int(self.connection.execute("SELECT value FROM meta WHERE key = 'epoch'").fetchone()[0])
+            rows = self.connection.execute(
+                "SELECT id, source, filename, type, timestamp, end, frames, caption FROM rows "
+                "WHERE alive = 1 ORDER BY id",
+            ).fetchall()
+        ids = np.array([row[0] for row in rows], dtype=np.int64)
+        columns = [(self._hash_path, np.uint64, HASH_WORDS)]
+        if self.dim:
+            columns.append((self._path, DTYPES[self.dtype], self.dim))
+        for path, dtype, width in columns:
+            with path(epoch + 1).open("wb") as file:
+                if len(ids):
+                    old = np.memmap(path(epoch), dtype=dtype, mode="r").reshape(-1, width)
+                    for start in range(0, len(ids), CHUNK_ROWS):
+                        file.write(np.ascontiguousarray(old[ids[start : start + CHUNK_ROWS]]).tobytes())
+        matrix = None
+        if self.dim and len(ids):
+            matrix = np.memmap(self._path(epoch + 1), dtype=DTYPES[self.dtype], mode="r").reshape(-1, self.dim)
+        centroids = self._train(matrix) if train and matrix is not None else None
+        lists = self._assign(matrix, centroids) if centroids is not None else np.full(len(ids), -1)
+        segments = segment_ids(0, [(row[1], row[4]) for row in rows])
+        centroids_name = ""
+        if centroids is not None:
+            centroids_name = f"centroids-{epoch + 1}.npy"
+            np.save(self.root / centroids_name, centroids)
+        with self.lock, self.connection:
+            self.connection.execute("DELETE FROM rows")
+            self.connection.executemany(
+                "INSERT INTO rows (id, source, filename, type, timestamp, end, frames, caption, list, segment) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (index, *row[1:], int(cell), segment)
+                    for index, (row, cell, segment) in enumerate(zip(rows, lists, segments, strict=True))
+                ],
+            )
+            self._set_meta(
+                {
+                    "epoch": epoch + 1,
+                    "rows": len(rows),
+                    "centroids": centroids_name,
+                    "trained_rows": len(rows) if centroids is not None else 0,
+                },
+            )
+        # Readers that still map the old file keep it alive until they move on to the new epoch.
+        self._path(epoch).unlink(missing_ok=True)
+        self._hash_path(epoch).unlink(missing_ok=True)
+        (self.root / f"centroids-{epoch}.npy").unlink(missing_ok=True)
+        logger.info(f"Rewrote the vector store with {len(rows)} rows, ivf={'on' if centroids is not None else 'off'}")
+
+    def _train(self, matrix: np.ndarray) -> np.ndarray:
+        """Train `nlist` k-means centroids (spherical) on a sample of the rows."""
+        rng = np.random.default_rng(0)
+        nlist = min(self.nlist, len(matrix))
+        sample_size = min(len(matrix), nlist * KMEANS_SAMPLE_PER_LIST)
+        sample = self._dequantize(matrix[np.sort(rng.choice(len(matrix), sample_size, replace=False))])
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)]
+        for _ in range(KMEANS_ITERATIONS):
+            assignment = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignment, sample)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            centroids = np.where(norms > 0, sums / np.maximum(norms, 1e-12), centroids)
+        return centroids.astype(np.float32)
+
+    def _assign(self, matrix: np.ndarray, centroids: np.ndarray) -> np.ndarray:
+        """Assign every row to its closest centroid."""
+        return np.concatenate(
+            [
+                np.argmax(self._dequantize(matrix[start : start + CHUNK_ROWS]) @ centroids.T, axis=1)
+                for start in range(0, len(matrix), CHUNK_ROWS)
+            ],
+        )
+
+    def _dequantize(self, rows: np.ndarray) -> np.ndarray:
+        """Convert stored rows back to float32."""
+        values = rows.astype(np.float32)
+        return values / INT8_SCALE if self.dtype == "int8" else values
+
+    def _load_centroids(self) -> np.ndarray | None:
+        """Load the IVF centroids, if trained."""
+        name = self._meta("centroids")
+        return np.load(self.root / name) if name else None
+
+    def _refresh(self) -> None:
+        """Bring the in-memory view up to date with the rows committed by the writer.
+
+        A rewrite in the ingesting process can delete the files of the epoch just read before they
+        are mapped, the view is then loaded again from the new epoch.
+        """
+        for attempt in range(REFRESH_ATTEMPTS):
+            try:
+                self._load()
+            except FileNotFoundError:
+                if attempt == REFRESH_ATTEMPTS - 1:
+                    raise
+                logger.debug("The vector store was rewritten while it was loaded, loading it again")
+            else:
+                return
+
+    def _load(self) -> None:
+        """Read the metadata and rows of one committed snapshot and map its files, see `_refresh`."""
+        with self.lock:
+            # One read transaction, so the metadata and the rows come from the same commit, and the
+            # files are mapped before it ends to keep the window for a concurrent rewrite small.
+            self.connection.execute("BEGIN")
+            try:
+                meta = dict(self.connection.execute("SELECT key, value FROM meta"))
+                epoch, count, deletes = int(meta["epoch"]), int(meta["rows"]), int(meta["deletes"])
+                reloaded = self.loaded is None or self.loaded[0] != epoch
+                if not reloaded and self.loaded == (epoch, count) and self.deletes == deletes:
+                    return
+                start = 0 if reloaded else self.loaded[1]
+                centroids = (
+                    (np.load(self.root / meta["centroids"]) if meta["centroids"] else None)
+                    if reloaded
+                    else self.centroids
+                )
+                rows = self.connection.execute(
+                    "SELECT type, list, segment FROM rows WHERE id >= ? AND id < ? ORDER BY id",
+                    (start, count),
+                ).fetchall()
+                dead = (
+                    np.array(
+                        self.connection.execute("SELECT id FROM rows WHERE alive = 0 AND id < ?", (count,)).fetchall(),
+                        dtype=np.int64,
+                    ).reshape(-1)
+                    if reloaded or self.deletes != deletes
+                    else None
+                )
+                matrix = (
+                    np.memmap(self._path(epoch), dtype=DTYPES[self.dtype], mode="r", shape=(count, self.dim))
+                    if count and self.dim
+                    else None
+                )
+                hashes = (
+                    np.memmap(self._hash_path(epoch), dtype=np.uint64, mode="r", shape=(count, HASH_WORDS))
+                    if count
+                    else None
+                )
+            finally:
+                self.connection.execute("COMMIT")
+        types = np.array([TYPE_CODES.get(row[0], 255) for row in rows], dtype=np.uint8)
+        lists = np.array([row[1] for row in rows], dtype=np.int32)
+        self.types = np.concatenate([self.types[:start], types])
+        self.lists = np.concatenate([self.lists[:start], lists])
+        self.segments = np.concatenate(
+            [self.segments[:start], np.array([row[2] for row in rows], dtype=np.int64)],
+        )
+        alive = np.ones(count, dtype=bool)
+        if dead is None:
+            alive[:start] = self.alive[:start]
+        else:
+            alive[dead] = False
+        self.alive = alive
+        self.deletes = deletes
+        self.centroids = centroids
+        self.matrix = matrix
+        self.hashes = hashes
+        self.loaded = (epoch, count)
+
+    def search(self, query: np.ndarray, k: int, typ: str | None = None) -> list[dict]:
+        """Find the `k` segments (of type `typ`) with a live row closest to a unit-norm float32 query vector."""
+        with self.refresh_lock:
+            self._refresh()
+            matrix, alive, types, lists, centroids = self.matrix, self.alive, self.types, self.lists, self.centroids
+            segments = self.segments
+            epoch = self.loaded[0]
+        if matrix is None or k <= 0:
+            return []
+        mask = alive if typ is None else alive & (types == TYPE_CODES[typ])
+        if centroids is not None:
+            probes = top_k(centroids @ query, self.nprobe)
+            mask = mask & np.isin(lists, probes)
+        candidates = np.flatnonzero(mask)
+        query = query.astype(np.float32)
+        best_ids: list[np.ndarray] = []
+        best_scores: list[np.ndarray] = []
+        for start in range(0, len(candidates), CHUNK_ROWS):
+            ids = candidates[start : start + CHUNK_ROWS]
+            scores = self._dequantize(matrix[ids]) @ query
+            order = top_k_distinct(scores, segments[ids], k)
+            best_ids.append(ids[order])
+            best_scores.append(scores[order])
+        if not best_ids:
+            return []
+        ids, scores = np.concatenate(best_ids), np.concatenate(best_scores)
+        order = top_k_distinct(scores, segments[ids], k)
+        results = self.describe(ids[order].tolist(), scores[order].tolist())
+        if self._meta("epoch") != str(epoch):
+            # The rows were renumbered by a rewrite while searching, search the new epoch instead.
+            return self.search(query, k, typ)
+        return results
+
+    def search_hash(self, image_hash: str, k: int, typ: str | None = None, max_distance: int = 64) -> list[dict]:
+        """Find the `k` segments (of type `typ`) with a live row whose perceptual hash is closest in Hamming distance.
+
+        Rows further than `max_distance` bits are left out, scores are the fraction of equal bits.
+        """
+        with self.refresh_lock:
+            self._refresh()
+            hashes, alive, types, segments = self.hashes, self.alive, self.types, self.segments
+            epoch = self.loaded[0]
+        if hashes is None or k <= 0:
+            return []
+        query = np.frombuffer(bytes.fromhex(image_hash), dtype=np.uint64)
+        mask = alive if typ is None else alive & (types == TYPE_CODES[typ])
+        best_ids: list[np.ndarray] = []
+        best_distances: list[np.ndarray] = []
+        for start in range(0, len(hashes), CHUNK_ROWS):
+            distances = np.bitwise_count(hashes[start : start + CHUNK_ROWS] ^ query).sum(axis=1, dtype=np.int32)
+            ids = np.flatnonzero(mask[start : start + CHUNK_ROWS] & (distances <= max_distance))
+            order = top_k_distinct(-distances[ids], segments[ids + start], k)
+            best_ids.append(ids[order] + start)
+            best_distances.append(distances[ids[order]])
+        ids, distances = np.concatenate(best_ids), np.concatenate(best_distances)
+        if not len(ids):
+            return []
+        order = top_k_distinct(-distances, segments[ids], k)
+        bits = 64 * HASH_WORDS
+        results = self.describe(ids[order].tolist(), (1 - distances[order] / bits).tolist())
+        if self._meta("epoch") != str(epoch):
+            return self.search_hash(image_hash, k, typ, max_distance)
+        return results
+
+    def __len__(self) -> int:
+        """Count the live rows."""
+        with self.refresh_lock:
+            self._refresh()
+            return int(self.alive.sum())
+
+    def describe(self, ids: list[int], scores: list[float]) -> list[dict]:
+        """Turn row ids into results shaped like the BM25 ones, dropping repeated (filename, timestamp) pairs."""
+        placeholders = ",".join("?" * len(ids))
+        with self.lock:
+            rows = {
+                row[0]: row[1:]
+                for row in self.connection.execute(
+                    "SELECT id, filename, caption, type, timestamp, end, frames FROM rows "  # noqa: S608
+                    f"WHERE id IN ({placeholders})",
+                    ids,
+                )
+            }
+        results = []
+        seen = set()
+        for row_id, score in zip(ids, scores, strict=True):
+            if row_id not in rows:
+                continue
+            filename, caption, typ, timestamp, end, frames = rows[row_id]
+            if (filename, timestamp) in seen:
+                continue
+            seen.add((filename, timestamp))
+            results.append(
+                {
+                    "filename": filename,
+                    "caption": caption,
+                    "type": typ,
+                    "timestamp": timestamp,
+                    "end": end,
+                    "frames": frames,
+                    "score": score,
+                },
+            )
+        return results
@@ -0,0 +1,83 @@
+"""Background watcher that keeps the index in sync with the media directories."""
+
+import os
+import threading
+import time
+from collections.abc import Callable, Iterable
+from pathlib import Path
+
+from loguru import logger
+
+
+class MediaWatcher:
+    """Poll media directories and run `on_change` once a burst of file changes has settled.
+
+    Polling only stats files, so it works on every filesystem (including network mounts where
+    inotify events are not delivered). A sync only starts after the directories stayed unchanged for
+    `debounce` seconds, which also keeps half-copied files out of the index. `on_files`, when set,
+    is called right away after every poll that saw files appear or disappear.
+    """
+
+    def __init__(
+        self,
+        roots: list[Path],
+        on_change: Callable[[], object],
+        poll_interval: float = 5,
+        debounce: float = 3,
+        on_files: Callable[[Iterable[str], Iterable[str]], object] | None = None,
+    ) -> None:
+        """Store the directories to watch and the callbacks to run.
+
+        `on_files` gets the paths of the files that appeared and of the ones that disappeared.
+        """
+        self.roots = roots
+        self.on_change = on_change
+        self.on_files = on_files
+        self.poll_interval = poll_interval
+        self.debounce = debounce
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="media-watcher", daemon=True)
+
+    def start(self) -> None:
+        """Start watching in a background thread."""
+        logger.info(f"Watching {', '.join(root.as_posix() for root in self.roots)} for changes")
+        self.thread.start()
+
+    def stop(self) -> None:
+        """Stop watching."""
+        self.stopped.set()
+        self.thread.join()
+
+    def snapshot(self) -> dict[str, tuple[int, int]]:
+        """Map every file below the roots to its size and mtime."""
+        files = {}
+        for root in self.roots:
+            for dirpath, _dirnames, filenames in os.walk(root):
+                for filename in filenames:
+                    path = os.path.join(dirpath, filename)  # noqa: PTH118
+                    try:
+                        stat = os.stat(path)  # noqa: PTH116
+                    except OSError:
+                        continue
+                    files[path] = (stat.st_size, stat.st_mtime_ns)
+        return files
+
+    def _run(self) -> None:
+        """Poll until stopped, the first poll always counts as a change to catch up on missed events."""
+        previous: dict[str, tuple[int, int]] | None = None
+        changed_at = time.monotonic()
+        while not self.stopped.wait(self.poll_interval):
+            current = self.snapshot()
+            if current != previous:
+                if self.on_files is not None:
+                    known = previous or {}
+                    self.on_files(current.keys() - known.keys(), known.keys() - current.keys())
+                previous = current
+                changed_at = time.monotonic()
+            if changed_at is None or time.monotonic() - changed_at < self.debounce:
+                continue
+            changed_at = None
+            try:
+                self.on_change()
+            except Exception as e:  # noqa: BLE001
+                logger.exception(f"Incremental ingestion failed: {e!s}")